@@ -12,6 +12,52 @@ Useful: https://www.ravellosystems.com/ravello-api-doc/
 Notes: In my testing, with >200 applications and ~1,000 virtual machines this took 30 seconds to execute.
        If the get_applications call in the Ravello Python SDK supported dumping design information this could be dramatically reduced.
 
+Caching: the generated inventory can be cached on disk by setting these options
+in the [ravello] section of ravello.ini:
+
+    cache_path = ~/.ansible/tmp
+    cache_max_age = 300
+
+cache_max_age is in seconds; 0 (the default) disables the cache.  Use
+--refresh-cache to force a new inventory to be fetched from Ravello.
+The hostvars of every host are also stored one file per host next to the
+cache file, so --host answers from a fresh cache in constant time.
+
+Application names are resolved to IDs through the per account name index
+shared with ravello_module (module_utils/ravello_utils.py), so a named app
+costs one request for its deployment instead of a download of every
+application.
+
+Incremental refresh: with the cache enabled, the deployment and the
+generated groups of each app are also kept in cache_path, along with the
+app's change marker (version and update times).  A refresh only fetches and
+rebuilds the apps whose marker moved.  Set incremental_refresh = false to
+rebuild everything on every refresh.
+
+Compact output: --compact (or compact_output = true) prints the inventory
+without indentation, one host or group at a time, and moves the generated
+ansible_ssh_common_args of each host into the vars of a _proxy_<fqdn> group
+shared by all hosts behind that proxy.  Note that group vars rank below
+playbook group_vars/all, unlike the host vars used otherwise.  The indented
+default is kept for the tools that grep the output line by line.
+
+Tags: with group_by_tags = true, every tag:<group> line of a VM description
+(outside of the #%ansible block) also adds the host to <group>, and a VM
+tagged bastion gets bastion: true in its hostvars.  Tags and the #%ansible
+block are read in the same scan of the description.
+
+Sessions: with session_cache = true the script reuses, and saves, the Ravello
+session kept in ~/.ravello_cache/sessions.json, the same cache used by
+ravello_module's session_cache option, instead of logging in on every run.
+
+Multiple applications: --list takes a comma separated list of app names, and
+--all builds the inventory from every published application.  Without a
+value, --list falls back to the apps option of ravello.ini ('*' means all).
+Deployments are fetched on up to fetch_workers (default 8) threads.  When more
+than one app is requested, hosts are named <app>_<hostname>, every group is
+namespaced as <app>_<group>, the plain <group> holds each app's copy as a
+child, and <app> groups all hosts of that application.
+
 jlabocki <at> redhat.com or @jameslabocki on twitter
 
 dbenoit  <at> redhat.com
@@ -19,16 +65,35 @@ dbenoit  <at> redhat.com
 
 import os
 import re
+import sys
+import time
+import hashlib
+import shutil
+import tempfile
+import threading
 import argparse
 import requests
 import json
 import yaml
+import collections
 from argparse import ArgumentParser
+from multiprocessing.pool import ThreadPool
 import base64
 import getpass
 import logging
 import logging.handlers
-from ravello_sdk import *
+
+try:
+    from ravello_sdk import *
+    HAS_RAVELLO_SDK = True
+except ImportError:
+    HAS_RAVELLO_SDK = False
+
+# Shared helpers live with the module utils of this repository
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)),
+    '..', 'module_utils'))
+from ravello_utils import RavelloNameIndex, RavelloSessionCache, \
+    atomic_write, read_json_file, client_account, FileLock
 
 # config parser is named differently
 # depending on the version and distro
@@ -37,89 +102,194 @@ try:
 except ImportError:
     import configparser as ConfigParser
 
-def get_ansible_attributes(vm):
-    y = vm['description'].partition("#%ansible")[2].partition("#%end")[0]
-    attrs = yaml.load(y)
+# Prefer the libyaml parser when it is available
+YamlLoader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+
+# One scan of a VM description finds both the #%ansible block and any
+# tag:<name> lines outside of it
+DESCRIPTION_RE = re.compile(r'#%ansible(.*?)(?:#%end|\Z)|^tag:([^:\r\n]*)',
+    re.S | re.M)
+
+def parse_vm_description(desc):
+    block = None
+    tags = []
+    for m in DESCRIPTION_RE.finditer(desc):
+        if m.group(2) is not None:
+            if m.group(2) not in tags:
+                tags.append(m.group(2))
+        elif block is None:
+            block = m.group(1)
+    return block or '', tags
+
+def load_ansible_attributes(y, vm):
+    attrs = None
+    if y.strip():
+        attrs = yaml.load(y, Loader=YamlLoader)
     if attrs == None:
         attrs = {}
     if 'name' not in attrs:
         attrs['name'] = vm['name']
     return attrs
 
-def create_inv_by_tag(vm, groups):
-    desc = vm['description']
-    hostname = vm['hostnames'][0]
-    for line in desc.splitlines():
-      if re.match("^tag:", line):
-        t = line.split(':')
-        tag = t[1]
-        if tag in groups.keys():
-          groups[tag]['hosts'].append(hostname)
-        else:
-          groups[tag] = {}
-          groups[tag]['hosts'] = [hostname]
-        if 'externalFqdn' in vm:
-          groups['_meta']['hostvars'][hostname] = { 'externalFqdn': vm['externalFqdn'] }
-        if tag == 'bastion' and 'externalFqdn' in vm:
-          groups['_meta']['hostvars'][hostname].update({ 'bastion': True })
-
-def create_inv_by_attributes(app, groups):
-    vms = app['deployment']['vms']
-    for vm in vms:
-        desc = vm['description']
-        hostname = vm['hostnames'][0]
-        attrs = get_ansible_attributes(vm)
-        vm_name = attrs['name']
-        if 'groups' not in attrs:
-            attrs['groups'] = []
-        if vm_name not in attrs['groups']:
-            attrs['groups'].append(vm_name)
-        for g in attrs['groups']:
-            if g not in groups:
-                groups[g] = {}
-            if 'hosts' not in groups[g]:
-                groups[g]['hosts'] = []
-            groups[g]['hosts'].append(hostname)
-        if 'externalFqdn' in vm:
-          groups['_meta']['hostvars'][hostname] = \
-            { 
-              'externalFqdn': vm['externalFqdn'] 
+def get_ansible_attributes(vm):
+    y = vm['description'].partition("#%ansible")[2].partition("#%end")[0]
+    return load_ansible_attributes(y, vm)
+
+# Everything the inventory needs from one VM, parsed once
+VmRecord = collections.namedtuple('VmRecord',
+    ['hostname', 'name', 'groups', 'vars', 'proxy', 'externalFqdn', 'tags'])
+
+def parse_vm_record(vm):
+    block, tags = parse_vm_description(vm['description'])
+    attrs = load_ansible_attributes(block, vm)
+    groups = list(attrs.get('groups') or [])
+    if attrs['name'] not in groups:
+        groups.append(attrs['name'])
+    return VmRecord(
+        hostname=vm['hostnames'][0],
+        name=attrs['name'],
+        groups=groups,
+        vars=attrs.get('vars') or {},
+        proxy=attrs.get('proxy'),
+        externalFqdn=vm.get('externalFqdn'),
+        tags=tags)
+
+def app_prefix(app_name):
+    return re.sub(r'[^A-Za-z0-9_]', '_', app_name) + '_'
+
+def add_host_to_group(groups, group, host, prefix=''):
+    # With a prefix the host lands in the app's own <prefix><group>, and
+    # the plain group collects every app's copy of it as children
+    if prefix:
+        if group not in groups:
+            groups[group] = {}
+        if 'children' not in groups[group]:
+            groups[group]['children'] = []
+        if prefix + group not in groups[group]['children']:
+            groups[group]['children'].append(prefix + group)
+        group = prefix + group
+    if group not in groups:
+        groups[group] = {}
+    if 'hosts' not in groups[group]:
+        groups[group]['hosts'] = []
+    groups[group]['hosts'].append(host)
+
+# Fields of an application listing entry that move whenever the app
+# is changed, redeployed or republished
+APP_CHANGE_MARKERS = ('version', 'lastUpdateTime', 'deploymentUpdateTime')
+
+def app_change_marker(app):
+    if not any(k in app for k in APP_CHANGE_MARKERS):
+        return None
+    return [app.get(k) for k in APP_CHANGE_MARKERS + ('published',)]
+
+def merge_inventory(groups, app_groups):
+    for name, group in app_groups.items():
+        if name == '_meta':
+            groups['_meta']['hostvars'].update(group['hostvars'])
+            continue
+        if name not in groups:
+            groups[name] = {}
+        if 'hosts' in group:
+            groups[name].setdefault('hosts', []).extend(group['hosts'])
+        for child in group.get('children', []):
+            children = groups[name].setdefault('children', [])
+            if child not in children:
+                children.append(child)
+
+def proxy_ssh_args(host, proxy):
+    return '-o StrictHostKeyChecking=no -o ProxyCommand="ssh -i {{ hostvars["' + host + '"]["ansible_ssh_private_key_file"] }} -W %h:%p -q {{ hostvars["' + proxy + '"]["ansible_user"] }}@'  + proxy + '"'
+
+# The same ProxyCommand for every host behind proxy, templated per host
+def shared_proxy_ssh_args(proxy):
+    return '-o StrictHostKeyChecking=no -o ProxyCommand="ssh -i {{ ansible_ssh_private_key_file }} -W %h:%p -q {{ hostvars["' + proxy + '"]["ansible_user"] }}@'  + proxy + '"'
+
+def hoist_proxy_args(groups):
+    # Moves the generated ProxyCommand of each host into the vars of a
+    # _proxy_<fqdn> group, so it is written once per proxy, not per host
+    hostvars = groups['_meta']['hostvars']
+    for host, hvars in hostvars.items():
+        proxy = hvars.get('proxyFqdn')
+        if proxy is None:
+            continue
+        if hvars.get('ansible_ssh_common_args') != proxy_ssh_args(host, proxy):
+            continue
+        del hvars['ansible_ssh_common_args']
+        group = '_proxy_' + re.sub(r'[^A-Za-z0-9_]', '_', proxy)
+        if group not in groups:
+            groups[group] = {
+                'hosts': [],
+                'vars': {'ansible_ssh_common_args': shared_proxy_ssh_args(proxy)}
             }
-        groups['_meta']['hostvars'][hostname]['hostIsProxy'] = False
-        groups['_meta']['hostvars'][hostname]['hostnameIsProxy'] = False
+        groups[group]['hosts'].append(host)
+
+def inventory_json_chunks(groups, compact):
+    if not compact:
+        yield json.dumps(groups, indent=5)
+        return
+    # One chunk per host and group keeps the C encoder in use while
+    # letting the output be written as it is generated
+    separators = (',', ':')
+    yield '{"_meta":{"hostvars":{'
+    sep = ''
+    for host, hvars in groups['_meta']['hostvars'].items():
+        yield sep + json.dumps(host) + ':' + json.dumps(hvars, separators=separators)
+        sep = ','
+    yield '}}'
+    for name, group in groups.items():
+        if name != '_meta':
+            yield ',' + json.dumps(name) + ':' + json.dumps(group, separators=separators)
+    yield '}'
+
+def create_inv_by_attributes(app, groups, prefix='', by_tags=False):
+    hostvars = groups['_meta']['hostvars']
+    records = [parse_vm_record(vm) for vm in app['deployment']['vms']]
+    # First host of each group, so a proxy is found without a group scan
+    group_head = {}
+    for r in records:
+        host = prefix + r.hostname
+        for g in r.groups:
+            add_host_to_group(groups, g, host, prefix)
+            if g not in group_head:
+                group_head[g] = host
+        if prefix:
+            add_host_to_group(groups, prefix[:-1], host)
+        hostvars[host] = {}
+        if r.externalFqdn is not None:
+            hostvars[host]['externalFqdn'] = r.externalFqdn
+        if by_tags:
+            for tag in r.tags:
+                if tag not in r.groups:
+                    add_host_to_group(groups, tag, host, prefix)
+                if tag == 'bastion' and r.externalFqdn is not None:
+                    hostvars[host]['bastion'] = True
+        if prefix:
+            hostvars[host]['ansible_host'] = r.hostname
+        hostvars[host]['hostIsProxy'] = False
+        hostvars[host]['hostnameIsProxy'] = False
     # Second pass after all fqdns are populated
-    for vm in vms:
-        desc = vm['description']
-        attrs = get_ansible_attributes(vm)
-        hostname = vm['hostnames'][0]
-        vm_name = attrs['name']
-        hostname = vm['hostnames'][0]
-        if 'vars' in attrs:
-            hvars = attrs['vars']
+    for r in records:
+        host = prefix + r.hostname
+        hvars = dict(r.vars)
+        if r.proxy is not None:
+            proxy_name = group_head[r.proxy]
         else:
-            hvars = {}
-        if 'proxy' in attrs:
-            proxy_name = groups[attrs['proxy']]['hosts'][0]
-        else:
-            proxy_name = hostname
-        proxy = groups['_meta']['hostvars'][proxy_name]['externalFqdn']
-        groups['_meta']['hostvars'][hostname]['proxyFqdn'] = proxy
-        groups['_meta']['hostvars'][proxy_name]['hostIsProxy'] = True
-        hvars['ansible_ssh_common_args'] = '-o StrictHostKeyChecking=no -o ProxyCommand="ssh -i {{ hostvars["' + hostname + '"]["ansible_ssh_private_key_file"] }} -W %h:%p -q {{ hostvars["' + proxy + '"]["ansible_user"] }}@'  + proxy + '"'
-        for k, v in hvars.iteritems():
-            groups['_meta']['hostvars'][hostname][k] = v 
-    for vm in vms:
-        hostname = vm['hostnames'][0]
-        attrs = get_ansible_attributes(vm)
-        vm_name = attrs['name']
-        if groups['_meta']['hostvars'][hostname]['hostIsProxy']:
-            fqdn = groups['_meta']['hostvars'][hostname]['externalFqdn']
-            groups['_meta']['hostvars'][fqdn] = \
-              groups['_meta']['hostvars'][hostname].copy() 
-            groups['_meta']['hostvars'][fqdn]['hostnameIsProxy'] = True
-            del groups['_meta']['hostvars'][fqdn]['ansible_ssh_common_args']
-            groups[vm_name + "_public"] = {"hosts" :  [fqdn]}
-        
+            proxy_name = host
+        proxy = hostvars[proxy_name]['externalFqdn']
+        hostvars[host]['proxyFqdn'] = proxy
+        hostvars[proxy_name]['hostIsProxy'] = True
+        hvars['ansible_ssh_common_args'] = proxy_ssh_args(host, proxy)
+        hostvars[host].update(hvars)
+    for r in records:
+        host = prefix + r.hostname
+        if hostvars[host]['hostIsProxy']:
+            fqdn = hostvars[host]['externalFqdn']
+            hostvars[fqdn] = hostvars[host].copy()
+            hostvars[fqdn]['hostnameIsProxy'] = True
+            hostvars[fqdn].pop('ansible_host', None)
+            del hostvars[fqdn]['ansible_ssh_common_args']
+            add_host_to_group(groups, r.name + "_public", fqdn, prefix)
+
 def get_credentials():
 	with open(os.path.expanduser("~/.ravello_login"),"r") as pf:
 		username = pf.readline().strip()
@@ -144,10 +314,13 @@ def get_user_credentials(username):
 
 	return username,password
 
-def connect(username, password):
+def connect(username, password, session_cache=None):
         client = RavelloClient()
         try:
-                client.login(username, password)
+                if session_cache:
+                        client = session_cache.login(client, username, password)
+                else:
+                        client.login(username, password)
         except Exception as e:
                 print('Error: Invalid user credentials, username {0}'.format(username))
                 return None
@@ -166,8 +339,8 @@ class RavelloInventory(object):
     def _empty_inventory(self):
         return {"_meta" : {"hostvars" : {}}}
 
-    def __init__(self):
-        ''' Main execution path '''
+    def __init__(self, argv=None):
+        ''' Main execution path.  argv defaults to the command line '''
 
         # Inventory grouped by instance IDs, tags, security groups, regions,
         # and availability zones
@@ -178,25 +351,60 @@ class RavelloInventory(object):
 
         # Read CLI arguments
         self.read_settings()
-        self.parse_cli_args()
+        self.parse_cli_args(argv)
 
         # If --apps is set then run get_apps_all
         #if self.args.apps is True:
         #  self.get_apps_all()
 
-        # If --list is set then run get_app with ID of application 
-        if self.args.list is not None:
-          self.get_app()
+        # If --host is set then print the variables of that one host
+        if self.args.host:
+          self.get_host()
+
+        # If --list is set then run get_app with ID of application,
+        # unless a fresh copy is already in the cache
+        elif self.args.list is not None:
+          if self.args.refresh_cache or not self.is_cache_valid():
+            self.get_app()
+          else:
+            self.print_cached_inventory()
 
-    def parse_cli_args(self):
+    def parse_cli_args(self, argv=None):
         ''' Command line argument processing '''
 
         parser = argparse.ArgumentParser(description='Produce an Ansible Inventory file based on Ravello')
         parser.add_argument('--apps', action='store_false',
                            help='List all app names (default: False)')
-        parser.add_argument('--list', action='store', default=False,
-                           help='Get the group(s) and hostname(s) from a specific application by specifying the app name')
-        self.args = parser.parse_args()
+        parser.add_argument('--list', action='store', nargs='?', const='', default=False,
+                           help='Get the group(s) and hostname(s) from specific applications by specifying a comma separated list of app names')
+        parser.add_argument('--all', action='store_true', default=False,
+                           help='Get the group(s) and hostname(s) from all published applications')
+        parser.add_argument('--host', action='store',
+                           help='Get all the variables about a specific host')
+        parser.add_argument('--compact', action='store_true', default=self.compact,
+                           help='Print compact JSON with the ssh proxy arguments moved to group vars (default: False)')
+        parser.add_argument('--refresh-cache', action='store_true', default=False,
+                           help='Force refresh of cache by making API requests to Ravello (default: False - use cache files)')
+        self.args = parser.parse_args(argv)
+
+        if self.args.list:
+            app_names = self.args.list
+        else:
+            app_names = self.apps
+        self.app_names = [n.strip() for n in app_names.split(',') if n.strip()]
+        self.all_apps = self.args.all or self.app_names == ['*']
+
+        if self.all_apps:
+            cache_name = '_all'
+        else:
+            cache_name = re.sub(r'[^A-Za-z0-9_.-]', '_', ','.join(self.app_names))
+        if len(cache_name) > 64:
+            cache_name = hashlib.md5(cache_name.encode('utf-8')).hexdigest()
+        # compact output is cached apart, plain --list must stay indented
+        if self.args.compact:
+            cache_name += '.compact'
+        self.cache_path_inventory = os.path.join(self.cache_path,
+            'ansible-ravello-%s.cache' % cache_name)
 
     def read_settings(self):
         ''' Reads the settings from the ravello.ini file '''
@@ -234,10 +442,143 @@ class RavelloInventory(object):
             print("ERROR: Could not get Ravello credentials from INI file or .ravello_login (SDK Auth)")
             exit(1)
 
+        # Reuse the session shared with ravello_module
+        self.session_cache = None
+        if config.has_option('ravello', 'session_cache'):
+            if config.getboolean('ravello', 'session_cache'):
+                self.session_cache = RavelloSessionCache()
+
+        # Cache related
+        if config.has_option('ravello', 'cache_path'):
+            self.cache_path = os.path.expanduser(config.get('ravello', 'cache_path'))
+        else:
+            self.cache_path = os.path.expanduser('~/.ansible/tmp')
+
+        if config.has_option('ravello', 'cache_max_age'):
+            self.cache_max_age = config.getint('ravello', 'cache_max_age')
+        else:
+            self.cache_max_age = 0
+
+        # Application selection
+        if config.has_option('ravello', 'apps'):
+            self.apps = config.get('ravello', 'apps')
+        else:
+            self.apps = ''
+
+        if config.has_option('ravello', 'fetch_workers'):
+            self.fetch_workers = max(1, config.getint('ravello', 'fetch_workers'))
+        else:
+            self.fetch_workers = 8
+
+        if config.has_option('ravello', 'compact_output'):
+            self.compact = config.getboolean('ravello', 'compact_output')
+        else:
+            self.compact = False
+
+        if config.has_option('ravello', 'group_by_tags'):
+            self.group_by_tags = config.getboolean('ravello', 'group_by_tags')
+        else:
+            self.group_by_tags = False
+
+        # Incremental refresh only applies when caching is on
+        if config.has_option('ravello', 'incremental_refresh'):
+            self.incremental = config.getboolean('ravello', 'incremental_refresh')
+        else:
+            self.incremental = True
+        self.incremental = self.incremental and self.cache_max_age > 0
+
+    def is_cache_valid(self):
+        ''' Determines if the cache file has expired, or if it is still valid '''
+
+        if self.cache_max_age <= 0:
+            return False
+        if os.path.isfile(self.cache_path_inventory):
+            mod_time = os.path.getmtime(self.cache_path_inventory)
+            if (mod_time + self.cache_max_age) > time.time():
+                return True
+        return False
+
+    def print_cached_inventory(self):
+        ''' Prints the inventory from the cache file without parsing it '''
+
+        with open(self.cache_path_inventory, 'r') as cache:
+            sys.stdout.write(cache.read())
+        sys.stdout.write('\n')
+
+    def host_cache_file(self, host):
+        ''' One small file per host, so --host reads only what it prints '''
+
+        name = hashlib.md5(host.encode('utf-8')).hexdigest()
+        return os.path.join(self.cache_path_inventory + '.hosts', name + '.json')
+
+    def write_host_cache(self, groups):
+        ''' Swaps in a new per-host store.  This happens before the
+        inventory file is replaced since that file decides cache validity.
+        The swap takes two renames, so it holds the store's lock, which
+        get_host also takes to read '''
+
+        if not os.path.isdir(self.cache_path):
+            os.makedirs(self.cache_path)
+        host_dir = self.cache_path_inventory + '.hosts'
+        tmp_dir = tempfile.mkdtemp(dir=self.cache_path, prefix='.ansible-ravello-hosts-')
+        try:
+            for host, hostvars in groups['_meta']['hostvars'].items():
+                name = os.path.basename(self.host_cache_file(host))
+                with open(os.path.join(tmp_dir, name), 'w') as f:
+                    json.dump(hostvars, f)
+            with FileLock(host_dir + '.lock'):
+                if os.path.isdir(host_dir):
+                    os.rename(host_dir, tmp_dir + '.old')
+                os.rename(tmp_dir, host_dir)
+        finally:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            shutil.rmtree(tmp_dir + '.old', ignore_errors=True)
+
+    def write_inventory(self, groups, out):
+        ''' Writes the inventory to the cache, when enabled, and to out.
+        The cache file is replaced atomically, so that concurrent runs
+        never read a partially written inventory. '''
+
+        cache = self.cache_max_age > 0
+        if cache:
+            self.write_host_cache(groups)
+        if self.args.compact:
+            hoist_proxy_args(groups)
+        chunks = inventory_json_chunks(groups, self.args.compact)
+        if cache:
+            data = ''.join(chunks)
+            atomic_write(self.cache_path_inventory, data)
+            chunks = [data]
+        if out is not None:
+            for chunk in chunks:
+                out.write(chunk)
+            out.write('\n')
+
+    def get_host(self):
+        ''' Prints the hostvars of one host, from the per-host store when
+        the cache is fresh '''
+
+        host_file = self.host_cache_file(self.args.host)
+        host_dir = os.path.dirname(host_file)
+        hostvars = None
+        if not self.args.refresh_cache and self.is_cache_valid():
+            with FileLock(host_dir + '.lock'):
+                if os.path.isdir(host_dir):
+                    hostvars = read_json_file(host_file, {})
+        if hostvars is None:
+            groups = self.build_inventory()
+            if groups is None:
+                hostvars = {}
+            else:
+                hostvars = groups['_meta']['hostvars'].get(self.args.host, {}).copy()
+                self.write_inventory(groups, None)
+        print(json.dumps(hostvars, indent=5))
+
 
     def get_apps_all(self):
         #Connect to Ravello
-        client = connect(self.ravello_username, self.ravello_password)
+        client = connect(self.ravello_username, self.ravello_password,
+                    self.session_cache)
         if not client:
             exit (1)
 
@@ -253,41 +594,147 @@ class RavelloInventory(object):
           print(name)
 
 
-    def get_app(self):
+    def map_on_workers(self, client, refs, fetch):
+        ''' Calls fetch(client, ref) for each reference, on a bounded
+        thread pool when there is more than one '''
+
+        if len(refs) < 2:
+            return [fetch(client, ref) for ref in refs]
+
+        # The SDK client keeps a single connection, so each worker
+        # thread uses its own; with session_cache they share one login
+        local = threading.local()
+        def fetch_ref(ref):
+            if not hasattr(local, 'client'):
+                local.client = connect(self.ravello_username, self.ravello_password,
+                    self.session_cache)
+                if not local.client:
+                    raise Exception('Could not connect to Ravello')
+            return fetch(local.client, ref)
+
+        pool = ThreadPool(min(self.fetch_workers, len(refs)))
+        try:
+            return pool.map(fetch_ref, refs)
+        finally:
+            pool.close()
+            pool.join()
+
+    def select_apps(self, client, index):
+        ''' Returns the listing entry of each published app to inventory '''
+
+        if self.all_apps:
+            apps = client.get_applications()
+        elif self.incremental:
+            # Fresh listing entries carry the change markers
+            apps = self.map_on_workers(client, self.app_names,
+                lambda client, name: index.find(client, 'application', name))
+        else:
+            apps = []
+            for name in self.app_names:
+                app_id = index.lookup(client, 'application', name)
+                if app_id is not None:
+                    apps.append({'id': app_id, 'name': name, 'published': True})
+        #Only get the published apps
+        return [app for app in apps if app and app['published']]
+
+    def app_cache_file(self, app_id):
+        return os.path.join(self.cache_path, 'ansible-ravello-apps',
+            '%s.json' % app_id)
+
+    def get_app_inventories(self, client, index, apps, namespaced):
+        ''' Builds the groups and hostvars of each app, reusing the stored
+        result for apps whose change marker has not moved '''
+
+        inventories = {}
+        changed = []
+        for app in apps:
+            prefix = app_prefix(app['name']) if namespaced else ''
+            marker = app_change_marker(app)
+            stored = None
+            if self.incremental and marker is not None:
+                stored = read_json_file(self.app_cache_file(app['id']), None)
+            if stored and stored['marker'] == marker and stored['prefix'] == prefix \
+                    and stored.get('tags', False) == self.group_by_tags:
+                inventories[app['id']] = stored['inventory']
+            else:
+                changed.append((app, prefix, marker))
+
+        def fetch(client, entry):
+            if self.all_apps:
+                return client.get_application(entry[0]['id'], aspect="deployment")
+            name = entry[0]['name']
+            try:
+                return index.call_with_id(client, 'application', name,
+                    lambda app_id: client.get_application(app_id, aspect="deployment"))
+            except Exception:
+                # Deleted since it was indexed: skipped like unknown names
+                if index.cached('application', name) is None:
+                    return None
+                raise
+
+        for (app, prefix, marker), deployed in \
+                zip(changed, self.map_on_workers(client, changed, fetch)):
+            if not deployed or not deployed.get('published'):
+                continue
+            if not self.all_apps and str(deployed['name']) not in self.app_names:
+                continue
+            inventory = self._empty_inventory()
+            if deployed['deployment'] and "vms" in deployed["deployment"]:
+                create_inv_by_attributes(deployed, inventory, prefix,
+                    self.group_by_tags)
+            if self.incremental and marker is not None:
+                atomic_write(self.app_cache_file(app['id']), json.dumps({
+                    'marker': marker,
+                    'prefix': prefix,
+                    'tags': self.group_by_tags,
+                    'app': deployed,
+                    'inventory': inventory}))
+            inventories[app['id']] = inventory
+        return [inventories[app['id']] for app in apps if app['id'] in inventories]
+
+    def build_inventory(self):
+        ''' Returns the inventory of the selected apps, None if none exist '''
+
+        if not HAS_RAVELLO_SDK:
+            print("ERROR: ravello_sdk is required for this inventory script")
+            exit(1)
+
         #Connect to Ravello
-        myappname = self.args.list
-        client = connect(self.ravello_username, self.ravello_password)
+        client = connect(self.ravello_username, self.ravello_password,
+                    self.session_cache)
         if not client:
                 exit (1)
 
-        apps = client.get_applications()
+        index = RavelloNameIndex(client_account(client))
 
-        myappid = ""
+        # Namespace whenever more than one app was asked for, so the shape
+        # of the inventory does not depend on which apps exist right now
+        namespaced = self.all_apps or len(self.app_names) > 1
 
-        for app in apps:
-          #Only get the published apps
-          if app['published']:
-            if str(app['name']) == myappname:
-              myappid = app['id']
-        if myappid == "":
-          print(json.dumps(self._empty_inventory()))
-          return 0
+        apps = self.select_apps(client, index)
+        app_inventories = self.get_app_inventories(client, index, apps, namespaced)
+        if not app_inventories:
+          return None
 
         #First, define empty lists for the the tags, groups, subgroups for tags/vms, and the formatted list for tower.
         groups = {}
         groups['_meta'] = {}
         groups['_meta']['hostvars'] = {}
 
-        app = client.get_application(myappid, aspect="deployment")
+        for app_inventory in app_inventories:
+            merge_inventory(groups, app_inventory)
+        return groups
 
-        if app['deployment']:
-          appname = app['name']
-          if "vms" in app["deployment"]:
-              create_inv_by_attributes(app, groups)
-        print(json.dumps(groups, indent=5))  
+    def get_app(self):
+        groups = self.build_inventory()
+        if groups is None:
+          print(json.dumps(self._empty_inventory()))
+          return 0
+        self.write_inventory(groups, sys.stdout)
 
 #Run the script
-RavelloInventory()
+if __name__ == '__main__':
+    RavelloInventory()
 
             
 
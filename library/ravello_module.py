@@ -36,8 +36,6 @@ except ImportError:
     print("failed=True msg='ravello sdk required for this module'")
     sys.exit(1)
 
-from ravello_cli import get_diskimage
-
 from ansible.module_utils.ravello_utils import *
 
 DOCUMENTATION = '''
@@ -46,14 +44,17 @@ module: ravello_app
 short_description: Create/delete/start/stop an application in ravellosystems
 description:
      - Create/delete/start/stop an application in ravellosystems and wait for it (optionally) to be 'running'
+     - present state returns metrics, the seconds spent in each phase (metrics.phases) and the latency of every API call (metrics.api_calls), also when it fails
      - list state will return a fqdn list of exist application hosts with their external services
      - blueprint state will create a blueprint from an existing app (must provide blueprint_name)
+     - started, stopped and absent states act on every app of app_names at once, issuing the actions on up to bulk_workers threads and waiting for all of them together
+     - plan state (or design in check mode) validates an app_template and plans its network without a Ravello account, returning the application JSON and the API calls design would make
 options:
   state:
     description:
      - Indicate desired state of the target.
     default: present
-    choices: ['design', 'present', 'started', 'absent', 'stopped','list','blueprint']
+    choices: ['design', 'plan', 'present', 'started', 'absent', 'stopped','list','blueprint']
   username:
      description:
       - ravello username
@@ -67,6 +68,13 @@ options:
   name:
     description:
      - application name
+  app_names:
+    description:
+     - Names or shell style globs (matched case-insensitively) of the applications to start, stop or delete, instead of app_name.  The result has one entry per application in results.
+  bulk_workers:
+    description:
+     - Number of applications of app_names acted on, and polled while waiting, at a time.  All waits share one poll schedule on one event loop.  Each worker logs in on its own unless session_cache is set.
+    default: 8
   description:
     description:
      - application description
@@ -96,6 +104,18 @@ options:
     description:
      - How long before wait gives up, in seconds.
     default: 600
+  wait_for_services:
+    description:
+     - Once the app is started (present and started states), also wait until the external service_name service of every started VM accepts TCP connections.  The VMs are probed concurrently.
+    default: False
+    choices: [ True, False ]
+  service_timeout:
+    description:
+     - How long before wait_for_services gives up, in seconds.
+    default: 600
+  service_search_regex:
+    description:
+     - With wait_for_services, a service is only reachable once it sends a banner matching this regex, such as OpenSSH.
   blueprint_name:
     description:
      - Specify a name for a new blueprint based on existing app
@@ -104,10 +124,24 @@ options:
      - Description of new blueprint 
   app_template:
     description:
-     - Path to a YML file that defines an application infrastructure then creates a blueprint for further processing with follow-on playbooks.  Must use state=design
+     - Path to a YML file that defines an application infrastructure then creates a blueprint for further processing with follow-on playbooks.  Must use state=design or state=plan
   cost_bucket:
     description:
      - Cost bucket to assign to the app.  Defaults to first available cost bucket on account.
+  image_cache_ttl:
+    description:
+     - Seconds the disk image catalog used to check app_template images is kept in ~/.ravello_cache, per account, for later tasks.  0 fetches it once per task.
+    default: 0
+  metadata_cache:
+    description:
+     - Keep the cost buckets and the blueprint publish locations in ~/.ravello_cache/metadata.json for an hour, shared by parallel tasks, instead of downloading them on every task.
+    default: False
+    choices: [ True, False ]
+  session_cache:
+    description:
+     - Reuse the Ravello session of earlier tasks, kept in ~/.ravello_cache/sessions.json, instead of logging in on every task.
+    default: False
+    choices: [ True, False ]
 '''
 
 EXAMPLES = '''
@@ -122,6 +156,15 @@ EXAMPLES = '''
     wait: True
     wait_timeout: 600
     state: present
+# Same, also waiting until sshd answers on the external ssh service of every VM
+- local_action:
+    module: ravello_app
+    name: 'my-application-name'
+    blueprint_id: '2452'
+    wait_for_services: True
+    service_name: 'ssh'
+    service_search_regex: OpenSSH
+    state: present
 # Create app, based on blueprint
 - local_action:
     module: ravello_app
@@ -144,6 +187,15 @@ EXAMPLES = '''
     module: ravello_app
     name: 'my-application-name'
     state: absent
+# Delete every application of a training lab
+- local_action:
+    module: ravello_app
+    app_names:
+      - 'lab-seat-*'
+      - 'lab-instructor'
+    session_cache: True
+    state: absent
+  register: teardown_results
 # Create blueprint from existing app
 - local_action:
     module: ravello_app
@@ -159,6 +211,14 @@ EXAMPLES = '''
     app_template: 'app_template.yml'
     state: design
   register: design_results
+# Check app_template.yml offline, design_plan.application holds the app JSON
+# and design_plan.api_calls the calls state=design would make
+- local_action:
+    module: ravello_app
+    name: 'my-new-baseline'
+    app_template: 'app_template.yml'
+    state: plan
+  register: design_plan
 '''
 
 import os
@@ -168,23 +228,41 @@ import logging
 import logging.handlers
 
 ##### Ravello API Wrappers #####
-def set_cost_bucket(appID, appType, cost_bucket_name, client):
+def set_cost_bucket(appID, appType, cost_bucket_name, client, metadata=None):
+    metadata = metadata or RavelloMetadataCache(enabled=False)
+    resource = {'resourceId': appID, 'resourceType': appType}
+    cost_buckets = metadata.get('cost_buckets', 'execute',
+            lambda: client.get_cost_buckets(permissions='execute'))
+    names = [cost_bucket['name'] for cost_bucket in cost_buckets]
+    # "Default" falls back to the first bucket, see associate_cost_bucket
+    found = cost_bucket_name in names or \
+            (cost_bucket_name == "Default" and len(cost_buckets) >= 1)
+    if metadata.enabled and not found:
+        # the cached buckets may predate this one, fetch them again
+        metadata.invalidate('cost_buckets')
+        cost_buckets = metadata.get('cost_buckets', 'execute',
+                lambda: client.get_cost_buckets(permissions='execute'))
+    associate_cost_bucket(cost_buckets, cost_bucket_name, resource, client)
+
+def associate_cost_bucket(cost_buckets, cost_bucket_name, resource, client):
     available_cbs = [] 
-    cost_buckets =  client.get_cost_buckets(permissions='execute')
     for cost_bucket in cost_buckets:
         available_cbs.append(cost_bucket['name'])
         if cost_bucket['name'] == cost_bucket_name:
             client.associate_resource_to_cost_bucket(
-                         cost_bucket['id'], 
-                         {'resourceId': appID, 'resourceType': appType}) 
+                         cost_bucket['id'], resource) 
             return
     if (cost_bucket_name == "Default") and (len(cost_buckets) >= 1):
         client.associate_resource_to_cost_bucket(
-            cost_buckets[0]['id'], 
-            {'resourceId': appID, 'resourceType': appType}) 
+            cost_buckets[0]['id'], resource) 
         return
     raise Exception("Cost Bucket: " + cost_bucket_name + " - not found.  Available cost buckets: " + ', '.join(available_cbs))
-    return
+
+# Kept per account of the logged in client, the username may come from
+# ~/.ravello_login rather than the module parameters
+def get_metadata_cache(module, client):
+    return RavelloMetadataCache(account=client_account(client),
+            enabled=module.params.get('metadata_cache'))
 
 def get_credentials():
         with open(os.path.expanduser("~/.ravello_login"),"r") as pf:
@@ -215,10 +293,13 @@ def initlog(log_file):
         handler.setFormatter(logging.Formatter(fmt))
         logger.addHandler(handler)
 
-def connect(username, password):
-        client = RavelloClient()
+def connect(username, password, url=None, session_cache=None):
+        client = RavelloClient(url=url)
         try:
-                client.login(username, password)
+                if session_cache:
+                        client = session_cache.login(client, username, password)
+                else:
+                        client.login(username, password)
         except Exception as e:
                 sys.stderr.write('Error: {!s}\n'.format(e))
                 log.error('Invalid user credentials, username {0}'.format(username))
@@ -227,33 +308,21 @@ def connect(username, password):
         return client
 
 def get_app_id(app_name,client):
-        app_id=0
-        for app in client.get_applications():
-                if app['app_name'].lower() == app_name.lower():
-                        app_id = app['id']
-                        break
-        if app_id == 0:
-          module.fail_json(msg = 'ERROR: Cloud not find app: %s' % app_name)
+        app_id = RavelloNameIndex(client_account(client)).lookup(client, 'application', app_name)
+        if app_id is None:
+          module_fail('ERROR: Cloud not find app: %s' % app_name)
         return app_id
 
 def get_blueprint_id(blueprint_name,client):
-        blueprint_id=0
-        for blueprint in client.get_blueprints():
-                if blueprint['name'].lower() == blueprint_name.lower():
-                        blueprint_id = blueprint['id']
-                        break
-        if blueprint_id == 0:
-          module.fail_json(msg = 'ERROR: Cloud not find blueprint: %s' % blueprint_name)
+        blueprint_id = RavelloNameIndex(client_account(client)).lookup(client, 'blueprint', blueprint_name)
+        if blueprint_id is None:
+          module_fail('ERROR: Cloud not find blueprint: %s' % blueprint_name)
         return blueprint_id
 
 def get_image_id(image_name,client):
-        image_id=0
-        for image in client.get_images():
-                if image['name'].lower() == image_name.lower():
-                        image_id = image['id']
-                        break
-        if image_id == 0:
-          module.fail_json(msg = 'ERROR: Cloud not find VM image named: %s' % image_name)
+        image_id = RavelloNameIndex(client_account(client)).lookup(client, 'image', image_name)
+        if image_id is None:
+          module_fail('ERROR: Cloud not find VM image named: %s' % image_name)
         return image_id
 
 def get_image(image_id,client):
@@ -274,11 +343,13 @@ def main():
     argument_spec=dict(
             # for nested babu only
             url=dict(required=False, type='str'),
-            state=dict(default='present', choices=['design', 'present', 'started', 'absent', 'stopped', 'list', 'test', 'blueprint','blueprint_delete','blueprint_location']),
+            state=dict(default='present', choices=['design', 'plan', 'present', 'started', 'absent', 'stopped', 'list', 'test', 'blueprint','blueprint_delete','blueprint_location']),
             username=dict(required=False, type='str'),
             password=dict(required=False, type='str'),
             name=dict(required=False, type='str'),
             app_name=dict(required=False, type='str'),
+            app_names=dict(required=False, type='list'),
+            bulk_workers=dict(default=8, type='int'),
             description=dict(required=False, type='str'),
             blueprint_id=dict(required=False, type='str'),
             app_template=dict(required=False, default=None, type='path'),
@@ -291,23 +362,49 @@ def main():
             blueprint_name=dict(required=False, type='str'),
             wait=dict(type='bool', default=True),
             wait_timeout=dict(default=1200, type='int'),
-            cost_bucket=dict(default='Default', type='str')
+            wait_for_services=dict(type='bool', default=False),
+            service_timeout=dict(default=600, type='int'),
+            service_search_regex=dict(required=False, type='str'),
+            cost_bucket=dict(default='Default', type='str'),
+            session_cache=dict(type='bool', default=False),
+            image_cache_ttl=dict(default=0, type='int'),
+            metadata_cache=dict(type='bool', default=False)
     )
     module = AnsibleModule(
         argument_spec=argument_spec,
-        mutually_exclusive=[['blueprint', 'app_template']],
-        # We really really should support this...
-        # supports_check_mode = True
+        mutually_exclusive=[['blueprint', 'app_template'], ['app_name', 'app_names']],
+        supports_check_mode = True
     )
     module_fail.attach_ansible_modle(module)
+    state_arg = module.params.get('state')
+    # Fail before touching any application, not when waiting on services
+    if module.params.get('service_search_regex'):
+      try:
+        re.compile(module.params.get('service_search_regex'))
+      except re.error as e:
+        module.fail_json(msg='ERROR: Invalid service_search_regex: %s' % e)
+    # Plans are built against a local model, no account needed
+    if state_arg == 'plan' or (state_arg == 'design' and module.check_mode):
+      create_blueprint_from_template(PlanClient(), module)
+    elif module.check_mode:
+      module.exit_json(skipped=True, changed=False,
+              msg='check mode is only supported by the design and plan states')
     if not HAS_RAVELLO_SDK:
       module.fail_json(msg='ravello_sdk required for this module')
     # Get User credentials from Ansible (not too secure) or ENV variables (a little more secure)
     username = module.params.get('username', os.environ.get('RAVELLO_USERNAME', None)) 
     password = module.params.get('password', os.environ.get('RAVELLO_PASSWORD', None))
+    session_cache = None
+    if module.params.get('session_cache'):
+      session_cache = RavelloSessionCache()
     if username and password:
       try:
-        client = RavelloClient(username, password, module.params.get('url'))
+        if session_cache:
+          client = connect(username, password, module.params.get('url'), session_cache)
+          if not client:
+            raise Exception('login failed')
+        else:
+          client = RavelloClient(username, password, module.params.get('url'))
       except Exception as e:
         log_contents = log_capture_string.getvalue()
         log_capture_string.close()
@@ -323,25 +420,29 @@ def main():
       if not username or not password:
         module.fail_json(msg = 'ERROR: Unable to get any Ravello credentials!')
       try:
-        client = connect(username, password)
+        client = connect(username, password, module.params.get('url'), session_cache)
       except Exception as e:
         log_contents = log_capture_string.getvalue()
         log_capture_string.close()
         module.fail_json(msg = 'ERROR: Failed to authenticate to Ravello using Ravello SDK credentials cache %s' % e,stdout='%s' % log_contents)
-    state_arg = module.params.get('state')
-    if state_arg == 'design':
+    if state_arg in BULK_ACTIONS and module.params.get('app_names'):
+      url = module.params.get('url')
+      action_on_apps(module, client,
+              lambda: connect(username, password, url, session_cache),
+              forget=state_arg == 'absent')
+    elif state_arg == 'design':
       create_blueprint_from_template(client, module)
     elif state_arg == 'present':
       create_app_and_publish(client, module)
     elif state_arg == 'absent':
       action_on_app(module, client, 
               client.delete_application, 
-              lambda: None, 'Deleted')
+              lambda app_id: None, 'Deleted', forget=True)
     elif state_arg == 'started':
       action_on_app(module, client, 
               client.start_application, 
-              functools.partial(_wait_for_state,
-                  client,'STARTED',module), 'Started')
+              functools.partial(_wait_for_started,
+                  client,module), 'Started')
     elif state_arg == 'stopped':
       action_on_app(module, client, 
               client.stop_application, 
@@ -354,52 +455,95 @@ def main():
               client, client.create_blueprint)
     elif state_arg == 'blueprint_delete':
       action_on_blueprint(module, client, 
-              client.delete_blueprint)
+              client.delete_blueprint, forget=True)
     elif state_arg == 'blueprint_location':
+      metadata = get_metadata_cache(module, client)
       action_on_blueprint(module, client, 
-              client.get_blueprint_publish_locations)
+              lambda bp_id: metadata.get('publish_locations', bp_id,
+                  lambda: client.get_blueprint_publish_locations(bp_id)))
     elif state_arg == 'test':
       module.exit_json(msg = 'Authentication to Ravello successful')
 
-def _wait_for_state(client, state, module):
+# The metrics of a task that keeps RunMetrics, for fail_json and exit_json
+def metrics_result(metrics):
+    if metrics is None:
+        return {}
+    return {'metrics': metrics.as_dict()}
+
+def _wait_for_state(client, state, module, app_id=None, metrics=None):
     if module.params.get('wait') == False:
         return
     wait_timeout = module.params.get('wait_timeout')
-    app_id = 0
-    wait_till = time.time() + wait_timeout
-    while wait_till > time.time():
-        if app_id > 0:
-            app = client.get_application(app_id)
-        else:
-            app =  client.get_application_by_name(module.params.get('app_name'))
-            app_id = app['id']
-        states = list(set((vm['state'] \
-                for vm in app.get('deployment', {}).get('vms', []))))
+    if app_id is None:
+        app_id = get_app_id(module.params.get('app_name'), client)
+    # Poll the deployment by ID, often at first and backing off after
+    def reached():
+        app = client.get_application(app_id, aspect='deployment')
+        states = vm_states(app)
         if "ERROR" in states:
             log_contents = log_capture_string.getvalue()
             log_capture_string.close()
-            module.fail_json(msg = 'Vm got ERROR state',stdout='%s' % log_contents)
-        if len(states) == 1 and states[0] == state:
-            return
-        time.sleep(10)
+            module.fail_json(msg = 'Vm got ERROR state',stdout='%s' % log_contents,
+                    **metrics_result(metrics))
+        return states == set([state])
+    if poll_until(reached, wait_timeout):
+        return
     log_contents = log_capture_string.getvalue()
     log_capture_string.close()
     module.fail_json(msg = 'Timed out waiting for async operation to complete.',  
-            stdout='%s' % log_contents)
+            stdout='%s' % log_contents, **metrics_result(metrics))
+
+def _wait_for_started(client, module, app_id=None):
+    _wait_for_state(client, 'STARTED', module, app_id)
+    _wait_for_services(client, module, app_id)
+
+def _wait_for_services(client, module, app_id=None, metrics=None):
+    if not module.params.get('wait_for_services'):
+        return
+    if app_id is None:
+        app_id = get_app_id(module.params.get('app_name'), client)
+    app = client.get_application(app_id, aspect='deployment')
+    ready, unreachable = wait_for_services(app_services(app, module),
+            module.params.get('service_timeout'),
+            module.params.get('service_search_regex'))
+    if unreachable:
+        log_contents = log_capture_string.getvalue()
+        log_capture_string.close()
+        module.fail_json(msg = 'Timed out waiting for services: %s' % \
+                ', '.join('%s:%s' % service for service in unreachable),
+                stdout='%s' % log_contents, **metrics_result(metrics))
+
+# (fqdn, port) of the service_name external service of each started VM
+def app_services(app, module):
+    services = []
+    for vm in app.get('deployment', {}).get('vms', []):
+        if vm['state'] != "STARTED":
+            continue
+        service = get_list_app_vm_result(app, vm, module)
+        if service and service[0] and service not in services:
+            services.append(service)
+    return services
+
+def vm_states(app):
+    return set(vm['state'] for vm in app.get('deployment', {}).get('vms', []))
 
 def is_wait_for_external_service(supplied_service,module):
     return supplied_service['name'].lower() == \
             module.params.get('service_name').lower() and \
-            supplied_service['external'] == True
+            supplied_service.get('external') == True
 
 def get_list_app_vm_result(app, vm, module):
-    for supplied_service in vm['suppliedServices']:            
+    for supplied_service in vm.get('suppliedServices', []):
     	if is_wait_for_external_service(supplied_service, module):
-            for network_connection in vm['networkConnections']:
-                if network_connection['ipConfig']['id'] == \
-                        supplied_service['ipConfigLuid']:
+            # services bound by IP, or not yet published, lack these
+            luid = supplied_service.get('ipConfigLuid')
+            external_port = supplied_service.get('externalPort')
+            if luid is None or not external_port:
+                continue
+            for network_connection in vm.get('networkConnections', []):
+                if network_connection.get('ipConfig', {}).get('id') == luid:
                     dest = network_connection['ipConfig'].get('fqdn')
-                    port = int(supplied_service['externalPort'].split(",")[0].split("-")[0])
+                    port = int(external_port.split(",")[0].split("-")[0])
                     return (dest,port)
 	            
 def list_app(client, module):
@@ -421,12 +565,17 @@ def list_app(client, module):
         log_capture_string.close()
         module.fail_json(msg = '%s' % e,stdout='%s' % log_contents)
 
-def action_on_app(module, client, runner_func, waiter_func, action):
+def action_on_app(module, client, runner_func, waiter_func, action, forget=False):
     try:
         app_name = module.params.get("app_name")
-        app = client.get_application_by_name(app_name)
-        runner_func(app['id'])
-        waiter_func()
+        app_index = RavelloNameIndex(client_account(client))
+        def run(app_id):
+            runner_func(app_id)
+            return app_id
+        app_id = app_index.call_with_id(client, 'application', app_name, run)
+        if forget:
+            app_index.forget('application', app_name)
+        waiter_func(app_id)
         log_contents = log_capture_string.getvalue()
         log_capture_string.close()
         module.exit_json(changed=True, 
@@ -437,16 +586,146 @@ def action_on_app(module, client, runner_func, waiter_func, action):
         log_capture_string.close()
         module.fail_json(msg = '%s' % e,stdout='%s' % log_contents)
 
+# state -> (client method, state to wait for, action)
+BULK_ACTIONS = {
+    'absent': ('delete_application', None, 'Deleted'),
+    'started': ('start_application', 'STARTED', 'Started'),
+    'stopped': ('stop_application', 'STOPPED', 'Stopped'),
+}
+
+def action_on_apps(module, client, new_client, forget=False):
+    method, target_state, action = BULK_ACTIONS[module.params.get('state')]
+    try:
+        app_index = RavelloNameIndex(client_account(client))
+        apps, missing = app_index.match(client, 'application',
+                module.params.get('app_names'))
+        results = [{'app_name': name, 'changed': False, 'failed': True,
+                    'msg': 'Could not find application: %s' % name}
+                   for name in missing]
+        worker_client = client_pool(new_client)
+        def run(app):
+            result = {'app_name': app['name'], 'app_id': app['id'],
+                      'changed': False, 'failed': False}
+            try:
+                with worker_client() as worker:
+                    def act(app_id):
+                        getattr(worker, method)(app_id)
+                        return app_id
+                    result['app_id'] = app_index.call_with_id(worker,
+                            'application', app['name'], act)
+                result['changed'] = True
+                result['msg'] = '%s application: %s' % (action, app['name'])
+                if forget:
+                    app_index.forget('application', app['name'])
+            except Exception as e:
+                result.update(failed=True, msg='%s' % e)
+            return result
+        pool = ThreadPool(max(1, min(module.params.get('bulk_workers') or 1,
+                                     len(apps) or 1)))
+        try:
+            results.extend(pool.map(run, apps))
+        finally:
+            pool.close()
+            pool.join()
+        if target_state and module.params.get('wait'):
+            wait_for_apps_state(module, worker_client,
+                    [r for r in results if r['changed']], target_state)
+            if target_state == 'STARTED' and module.params.get('wait_for_services'):
+                wait_for_apps_services(module, worker_client,
+                        [r for r in results if r.get('state') == 'STARTED'])
+        failed = [r for r in results if r['failed']]
+        log_contents = log_capture_string.getvalue()
+        log_capture_string.close()
+        if failed:
+            module.fail_json(msg='%d of %d applications failed: %s' % (
+                    len(failed), len(results),
+                    '; '.join('%s: %s' % (r['app_name'], r['msg']) for r in failed)),
+                    changed=any(r['changed'] for r in results),
+                    results=results, stdout='%s' % log_contents)
+        module.exit_json(changed=any(r['changed'] for r in results),
+                results=results, stdout='%s' % log_contents)
+    except Exception as e:
+        log_contents = log_capture_string.getvalue()
+        log_capture_string.close()
+        module.fail_json(msg = '%s' % e,stdout='%s' % log_contents)
+
+# The SDK client keeps a single connection, so concurrent calls each take
+# a client of their own, created by new_client when none is idle
+def client_pool(new_client):
+    idle = []
+    @contextlib.contextmanager
+    def worker_client():
+        try:
+            client = idle.pop()
+        except IndexError:
+            client = new_client()
+            if not client:
+                raise Exception('Could not connect to Ravello')
+        try:
+            yield client
+        finally:
+            idle.append(client)
+    return worker_client
+
+# Waits for the deployments of every app to reach state from one
+# WaitMultiplexer, and records the outcome in each result
+def wait_for_apps_state(module, worker_client, results, state):
+    by_id = dict((r['app_id'], r) for r in results)
+    def reached(app_id):
+        with worker_client() as worker:
+            app = worker.get_application(app_id, aspect='deployment')
+        states = vm_states(app)
+        if 'ERROR' in states:
+            raise Exception('Vm got ERROR state')
+        return states == set([state])
+    waiter = WaitMultiplexer(reached, module.params.get('bulk_workers'))
+    ready, failed, pending = waiter.wait(list(by_id),
+            module.params.get('wait_timeout'))
+    for app_id in ready:
+        by_id[app_id]['state'] = state
+    for app_id, error in failed.items():
+        by_id[app_id].update(failed=True, msg='%s' % error)
+    for app_id in pending:
+        by_id[app_id].update(failed=True,
+                msg='Timed out waiting for state %s' % state)
+
+# Waits for the services of every app at once, and records the ones that
+# did not become reachable in each result
+def wait_for_apps_services(module, worker_client, results):
+    def fetch(result):
+        with worker_client() as worker:
+            return worker.get_application(result['app_id'], aspect='deployment')
+    pool = ThreadPool(max(1, min(module.params.get('bulk_workers') or 1,
+                                 len(results) or 1)))
+    try:
+        apps = pool.map(fetch, results)
+    finally:
+        pool.close()
+        pool.join()
+    services = {}
+    for result, app in zip(results, apps):
+        for service in app_services(app, module):
+            services[service] = result
+    ready, unreachable = wait_for_services(list(services),
+            module.params.get('service_timeout'),
+            module.params.get('service_search_regex'))
+    for service in unreachable:
+        result = services[service]
+        result['failed'] = True
+        result['msg'] = result.get('msg', '') + \
+                ', service %s:%s unreachable' % service
+
 def create_blueprint_from_existing_app(module, client, runner_func):
     app_name = module.params.get("app_name")
-    app = client.get_application_by_name(app_name)
+    app_id = get_app_id(app_name, client)
     blueprint_name = module.params.get("blueprint_name")
     blueprint_description = module.params.get("blueprint_description")
-    blueprint_dict = {"applicationId":app['id'], 
+    blueprint_dict = {"applicationId":app_id, 
             "blueprintName":blueprint_name, "offline": True,  
             "description":blueprint_description }
     try:
         blueprint_id=((runner_func(blueprint_dict))['_href'].split('/'))[2]
+        RavelloNameIndex(client_account(client)).remember('blueprint', blueprint_name, blueprint_id)
         log_contents = log_capture_string.getvalue()
         log_capture_string.close()
         module.exit_json(changed=True, 
@@ -458,14 +737,28 @@ def create_blueprint_from_existing_app(module, client, runner_func):
         log_capture_string.close()
         module.fail_json(msg = '%s' % e,stdout='%s' % log_contents)        
 
-def action_on_blueprint(module, client, runner_func):
+def action_on_blueprint(module, client, runner_func, forget=False):
+    bp_index = RavelloNameIndex(client_account(client))
+    blueprint_name = module.params.get("blueprint_name")
     if module.params.get("blueprint_id"):
       blueprint_id = module.params.get("blueprint_id")
-    elif module.params.get("blueprint_name"):
-      blueprint_name = module.params.get("blueprint_name")
+    elif blueprint_name:
       blueprint_id = get_blueprint_id(blueprint_name, client)
     try:
-        output = runner_func(blueprint_id)
+        if module.params.get("blueprint_id"):
+            output = runner_func(blueprint_id)
+        else:
+            # call_with_id retries once should the indexed ID be stale
+            def run(bp_id):
+                output = runner_func(bp_id)
+                return bp_id, output
+            blueprint_id, output = bp_index.call_with_id(client,
+                    'blueprint', blueprint_name, run)
+        if forget and blueprint_name:
+            bp_index.forget('blueprint', blueprint_name)
+        if forget:
+            get_metadata_cache(module, client).invalidate('publish_locations',
+                    blueprint_id)
         log_contents = log_capture_string.getvalue()
         log_capture_string.close()
         module.exit_json(changed=True, stdout='%s' % log_contents, 
@@ -515,14 +808,28 @@ def create_blueprint_from_template(client, module):
     ravello_template_set(app_request, 'description', app_description)
     ravello_template_set(app_request, 'design.vms', [])
 
-    # Check template is valid
+    # Check template is valid, against one listing of the disk images
+    images = RavelloImageCatalog(client,
+            max_age=module.params.get('image_cache_ttl') or 0)
+    validate_vms(client, module, read_app['vms'], images)
     for vm in read_app['vms']:
-      assert_vm_valid(client, module, vm)
       # Set Required Default
       vm['usingNewNetwork'] = True
       app_request['design']['vms'].append(vm)
+    # Use the subnets defined in the template, after checking they cover
+    # every VM IP, otherwise generate subnets compatible with the VM IPs
+    declared = None
+    if check_item_exists(read_app, 'network.subnets'):
+        declared = read_app['network']['subnets']
     try:
-        created_app = client.create_application(app_request)
+        netlist = plan_subnets(app_request, declared)
+    except Exception as e:
+        module.fail_json(msg='ERROR: %s' % e, changed=False)
+    # Update responses are kept, so the design steps below read the app
+    # back from the API only when Ravello's IDs are missing from them
+    app_docs = RavelloAppDocuments(client)
+    try:
+        created_app = app_docs.create(app_request)
     except Exception as e:
         log_contents = log_capture_string.getvalue()
         log_capture_string.close()
@@ -535,28 +842,23 @@ def create_blueprint_from_template(client, module):
             "offline": False, 
             "description":app_description 
             }
-    # Generate subnets if they are defined in the template
-    # Otherwise generate subnets compatible with defined VM IPs 
-    delete_autogenerated_subnet(client, module, appID)
-    if check_item_exists(read_app, 'network.subnets'):
-        netlist = []
-        for subnet in read_app['network']['subnets']:
-            netlist.append(IPNetwork(subnet))
-        netlist = sorted(netlist)
-        for i in range(len(netlist) - 1):
-            if (not IPSet(netlist[i]).isdisjoint(IPSet(netlist[i + 1]))):
-                raise Exception('Overlapping Subnets')
-            else:
-                create_subnet_with_ip_pool(client, module, appID, netlist[i])
-        create_subnet_with_ip_pool(client, module, appID, netlist[len(netlist) - 1])
-    else:
-        detect_ips_and_and_create_compatible_subnets(client, module, appID, app_request)
+    # Replace the Ravello auto-generated subnet with the planned ones
+    create_subnets_with_ip_pools(client, module, appID, netlist,
+            clear_autogenerated=True, app_docs=app_docs)
     # Get the ravello-assigned internal luids to fix assigned IPs and services
-    update_app_with_internal_luids(client, module, app_request, appID)
+    update_app_with_internal_luids(client, module, app_request, appID,
+            app_docs)
     try:
     # create bp from tmp-app and delete tmp-app
         blueprint_id= \
           ((client.create_blueprint(blueprint_dict))['_href'].split('/'))[2]
+        if getattr(client, 'offline', False):
+            planned_app = client.apps[appID]
+            client.delete_application(appID)
+            module.exit_json(changed=False, app_name='%s' % app_name,
+                    blueprint_name='%s' % blueprint_name,
+                    application=planned_app, api_calls=client.calls)
+        RavelloNameIndex(client_account(client)).remember('blueprint', blueprint_name, blueprint_id)
         client.delete_application(appID)
         module.exit_json(changed=True, app_name='%s' % app_name, 
                 blueprint_name='%s' % blueprint_name, 
@@ -567,10 +869,13 @@ def create_blueprint_from_template(client, module):
         module.fail_json(msg = '%s' % e,stdout='%s' % log_contents)
 
 def create_app_and_publish(client, module):
+    metrics = RunMetrics()
+    client = metrics.wrap(client)
     app_name = module.params.get("app_name")
     # Assert app does not exist in ravello
     
-    cap = client.get_applications({'name': app_name})
+    with metrics.phase('check'):
+      cap = client.get_applications({'name': app_name})
     if cap:
       module.fail_json(msg='ERROR: Application %s already exists!' % \
               app_name, changed=False)
@@ -591,30 +896,47 @@ def create_app_and_publish(client, module):
             'description': module.params.get("description",''), 
             'baseBlueprintId': module.params.get("blueprint_id")
             }    
-    app = client.create_application(app)
-    req = {}
-    if 'performance' == module.params.get("publish_optimization"):
-        req = {
-                'id': app['id'], 
-                'preferredRegion': module.params.get("region"), 
-                'optimizationLevel': 'PERFORMANCE_OPTIMIZED'
-                }
-    ttl=module.params.get("application_ttl")
-    if ttl != -1:
-        ttl =ttl * 60
-        exp_req = {'expirationFromNowSeconds': ttl}
-        client.set_application_expiration(app,exp_req)
-    client.publish_application(app, req)
-    set_cost_bucket(app['id'], 'application', 
-            module.params.get('cost_bucket'), client)
-    get_vm_hostnames(app['id'], client, module)
-    _wait_for_state(client,'STARTED',module)
+    try:
+        with metrics.phase('create'):
+          app = client.create_application(app)
+        RavelloNameIndex(client_account(client)).remember('application', app['name'], app['id'])
+        req = {}
+        if 'performance' == module.params.get("publish_optimization"):
+            req = {
+                    'id': app['id'], 
+                    'preferredRegion': module.params.get("region"), 
+                    'optimizationLevel': 'PERFORMANCE_OPTIMIZED'
+                    }
+        ttl=module.params.get("application_ttl")
+        if ttl != -1:
+            ttl =ttl * 60
+            exp_req = {'expirationFromNowSeconds': ttl}
+            with metrics.phase('set_expiration'):
+                client.set_application_expiration(app,exp_req)
+        with metrics.phase('publish'):
+            client.publish_application(app, req)
+        with metrics.phase('cost_bucket'):
+            set_cost_bucket(app['id'], 'application', 
+                    module.params.get('cost_bucket'), client,
+                    get_metadata_cache(module, client))
+        with metrics.phase('hostnames'):
+            get_vm_hostnames(app['id'], client, module)
+        with metrics.phase('wait'):
+            _wait_for_state(client,'STARTED',module,app['id'],metrics)
+        with metrics.phase('wait_for_services'):
+            _wait_for_services(client,module,app['id'],metrics)
+    except Exception as e:
+        log_contents = log_capture_string.getvalue()
+        log_capture_string.close()
+        module.fail_json(msg = '%s' % e,stdout='%s' % log_contents,
+                metrics=metrics.as_dict())
     log_contents = log_capture_string.getvalue()
     log_capture_string.close()
     module.exit_json(changed=True, 
             app_name='%s' % module.params.get("app_name"),
             stdout='%s' % log_contents, 
-            app_id='%s' % app['id'])
+            app_id='%s' % app['id'],
+            metrics=metrics.as_dict())
 
 def get_vm_hostnames(app_id, client, module):
     published_app = client.get_application(app_id, aspect='deployment')
@@ -635,12 +957,14 @@ import functools
 import logging
 import io
 import datetime
+import contextlib
 import sys
 import yaml
 import json
 import re
 
 from netaddr import *
+from multiprocessing.pool import ThreadPool
 
 logger = logging.getLogger()
 logger.setLevel(logging.DEBUG)
@@ -668,27 +992,26 @@ def assert_item_exists(json_item, jspath, **kwargs):
     return
 
 def check_item_exists(json_item, jspath, **kwargs):
-    path_exists = json_path_contains(json_item, jspath)
+    path_exists, item = compile_json_path(jspath).lookup(json_item)
     valid = from_kwargs(kwargs, 'valid', lambda n: True)
     is_valid = make_checker(valid)
-    result = path_exists and \
-       is_valid(ravello_template_get(json_item, jspath))
+    result = path_exists and is_valid(item)
     return result
 
 def set_default_if_missing(json_item, jspath, default, **kwargs):
-    path_exists = json_path_contains(json_item, jspath)
+    path = compile_json_path(jspath)
+    path_exists, item = path.lookup(json_item)
     valid = from_kwargs(kwargs, 'valid', lambda n: True)
     is_valid = make_checker(valid)
     if path_exists:
-        item = ravello_template_get(json_item, jspath)
         if not is_valid(item):
             raise Exception("invalid parameter: " + \
                 jspath + ": " +  json.dumps(item))
     else: 
-        ravello_template_set(json_item, jspath, default)
+        path.set(json_item, default)
     return 
 
-def assert_hd_valid(client, module, hd):
+def assert_hd_valid(client, module, hd, images=None):
     assert_item_exists(hd, 'index')
     assert_item_exists(hd, 'size.value', 
             valid=(lambda n: ((type(n) is int) and (n > 0))))
@@ -697,26 +1020,30 @@ def assert_hd_valid(client, module, hd):
     set_default_if_missing(hd, 'boot', False ,valid=[True, False])
     set_default_if_missing(hd, 'name', ('Disk' + hd['name']))
     set_default_if_missing(hd, 'size.unit', 'GB',valid=['GB', 'MB'])
-    assert_hd_image_exists_in_ravello(client, module, hd)
+    assert_hd_image_exists_in_ravello(client, module, hd, images)
     return hd
 
-def assert_hd_image_exists_in_ravello(client, module, hd):
+def assert_hd_image_exists_in_ravello(client, module, hd, images=None):
+    # Images cannot be checked without an account
+    if getattr(client, 'offline', False):
+      return
+    images = images or RavelloImageCatalog(client)
     # Check image name or ID exists in ravello
     if 'baseDiskImageId' in hd:
-      image = get_diskimage(client, hd['baseDiskImageId'])
+      image = images.find(hd['baseDiskImageId'])
       if image is None:
-        module.fail_json(msg=\
+        module_fail(
                 'FATAL ERROR nonexistent baseDiskImageId %s specified!' 
             % hd['baseDiskImageId'])
     elif 'imageName' in hd:
-      image = get_diskimage(client, hd['imageName'])
+      image = images.find(hd['imageName'])
       if image is None:
-        module.fail_json(msg=\
+        module_fail(
                 'FATAL ERROR nonexistent imageName %s specified!' 
            % hd['imageName'])
     if 'baseDiskImageId' in hd or 'imageName' in hd:
       if hd['size']['value'] < image['size']['value']:
-        module.fail_json(msg=\
+        module_fail(
                 'ERROR HD size value (%s) is smaller than the image (%s)' 
           % (hd['size']['value'], image['size']['value']))
       else:
@@ -743,7 +1070,7 @@ def assert_nic_valid(client, module, nic):
     if (auto_ip == static_ip):
         module_fail('Error: exactly one of [autoIpConfig,staticIpConfig] required')
 
-def assert_vm_valid(client, module, vm):
+def assert_vm_valid(client, module, vm, images=None):
     # Check Template Valid
     assert_item_exists(vm, 'numCpus')
     assert_item_exists(vm, 'memorySize.value')
@@ -763,7 +1090,7 @@ def assert_vm_valid(client, module, vm):
     ravello_template_set(vm, 'os', 'linux_manuel')
     #* set hard drives
     for hd in vm['hardDrives']:
-        hd = assert_hd_valid(client, module, hd)
+        hd = assert_hd_valid(client, module, hd, images)
     #* set nics
     for nic in vm['networkConnections']:
         assert_nic_valid(client, module, nic)
@@ -774,276 +1101,186 @@ def assert_vm_valid(client, module, vm):
     # add vm to app
     return vm
 
-def create_subnet_with_ip_pool(client, module, appID, netip):
-    # create the vlan switch
-    created_app = client.get_application(appID)
+# Validates every VM and fails once with the errors of all invalid VMs
+def validate_vms(client, module, vms, images=None):
+    images = images or RavelloImageCatalog(client)
+    errors = []
+    for vm in vms:
+        with module_fail.raising():
+            try:
+                assert_vm_valid(client, module, vm, images)
+            except Exception as e:
+                errors.append('VM %s: %s' % (vm.get('name', vm.get('hostnames')), e))
+    if errors:
+        module.fail_json(msg='ERROR: invalid app_template: ' + '; '.join(errors),
+                errors=errors, changed=False)
+
+# Builds the switch, subnet, L3 interface, router port and DHCP/DNS entries
+# of every network in netlist with three updates in all, rather than five
+# per network.  Each step needs IDs that Ravello assigns to the items added
+# by the step before, so the updates cannot be merged further.
+def create_subnets_with_ip_pools(client, module, appID, netlist,
+        clear_autogenerated=False, app_docs=None):
+    app_docs = app_docs or RavelloAppDocuments(client)
+    # create the vlan switches, dropping the autogenerated network first
+    created_app = app_docs.get(appID)
+    if clear_autogenerated:
+        clear_autogenerated_network(created_app)
+    if not netlist:
+        if clear_autogenerated:
+            app_docs.update(created_app)
+        return
     set_default_if_missing(created_app, 'design.network.switches', [])
-    new_switch_path = path_for_next_item(created_app, 'design.network.switches')
-    ravello_template_set(created_app, 
-            new_switch_path + '.networkSegments.0.vlanId', 1)
-    client.update_application(created_app)
-    # create the subnet
-    created_app = client.get_application(appID)
+    switch_paths = []
+    for netip in netlist:
+        new_switch_path = path_for_next_item(created_app,
+                'design.network.switches')
+        ravello_template_set(created_app,
+                new_switch_path + '.networkSegments.0.vlanId', 1)
+        switch_paths.append(new_switch_path)
+    app_docs.update(created_app)
+    # create the subnets and set their ip pools
+    created_app = app_docs.get(appID,
+            [p + '.networkSegments.0.id' for p in switch_paths])
     set_default_if_missing(created_app, 'design.network.subnets', [])
-    new_subnet_path = path_for_next_item(created_app, 'design.network.subnets')
-    ravello_template_set(created_app, new_subnet_path + '.ipVersion', 'IPV4')
-    ravello_template_set(created_app, new_subnet_path + '.mask', str(netip.netmask))
-    ravello_template_set(created_app, new_subnet_path + '.net', str(netip[0]))
-    new_switch_network_segment_id = \
-            ravello_template_get(created_app, 
-                new_switch_path + '.networkSegments.0.id')
-    ravello_template_set(created_app, 
-            new_subnet_path + '.networkSegmentId', 
-            new_switch_network_segment_id)
-    client.update_application(created_app)
-    # set the subnet ip pool
-    created_app = client.get_application(appID)
-    set_default_if_missing(created_app, 'design.network.services.networkInterfaces', [])
-    new_l3_nic_path = path_for_next_item(created_app,
-            'design.network.services.networkInterfaces')
-    ravello_template_set(created_app, 
-          new_l3_nic_path + \
-            '.ipConfigurations.0.staticIpConfig', 
-          {
-            'ip': str(netip[1]),
-            'mask': str(netip.netmask)
-          })
-    ravello_template_set(created_app, 
-          new_l3_nic_path + \
-            '.ipConfigurations.1.staticIpConfig', 
-          {
-            'ip': str(netip[2]),
-            'mask': str(netip.netmask)
-          })
-    client.update_application(created_app)
-    # attach the router
-    created_app = client.get_application(appID)
+    set_default_if_missing(created_app,
+            'design.network.services.networkInterfaces', [])
+    l3_nic_paths = []
+    for netip, switch_path in zip(netlist, switch_paths):
+        new_subnet_path = path_for_next_item(created_app,
+                'design.network.subnets')
+        ravello_template_set(created_app, new_subnet_path + '.ipVersion', 'IPV4')
+        ravello_template_set(created_app, new_subnet_path + '.mask', str(netip.netmask))
+        ravello_template_set(created_app, new_subnet_path + '.net', str(netip[0]))
+        ravello_template_set(created_app,
+                new_subnet_path + '.networkSegmentId',
+                ravello_template_get(created_app,
+                    switch_path + '.networkSegments.0.id'))
+        new_l3_nic_path = path_for_next_item(created_app,
+                'design.network.services.networkInterfaces')
+        ravello_template_set(created_app,
+              new_l3_nic_path + \
+                '.ipConfigurations.0.staticIpConfig',
+              {
+                'ip': str(netip[1]),
+                'mask': str(netip.netmask)
+              })
+        ravello_template_set(created_app,
+              new_l3_nic_path + \
+                '.ipConfigurations.1.staticIpConfig',
+              {
+                'ip': str(netip[2]),
+                'mask': str(netip.netmask)
+              })
+        l3_nic_paths.append(new_l3_nic_path)
+    app_docs.update(created_app)
+    # attach the router and create a dhcp server for each subnet
+    required = []
+    for p in l3_nic_paths:
+        required += [p + '.id', p + '.ipConfigurations.0.id',
+                p + '.ipConfigurations.1.id']
+    created_app = app_docs.get(appID, required)
     set_default_if_missing(created_app, \
         'design.network.services.routers.0.ipConfigurationIds', [])
-    router_ip_config_ids = ravello_template_get(created_app,
-            'design.network.services.routers.0.ipConfigurationIds')
-    router_ip_config_ids.append(ravello_template_get(created_app,
-                new_l3_nic_path + '.ipConfigurations.1.id'))
-    if 'ports' not in ravello_template_get(created_app, new_switch_path):
-        ravello_template_set(created_app, new_switch_path + '.ports', [])
-    create_port_on_switch(created_app, new_switch_path,
-            ravello_template_get(created_app,
-                new_l3_nic_path + '.id'),
-            'SERVICES')
-    client.update_application(created_app)
-    # create dhcp server for subnet
-    created_app = client.get_application(appID)
-    set_default_if_missing(created_app, 
+    set_default_if_missing(created_app,
         'design.network.services.dhcpServers', [])
-    new_dhcp_path = path_for_next_item(created_app,
-            'design.network.services.dhcpServers')
-    ravello_template_set(created_app, new_dhcp_path + '.mask', str(netip.netmask))
-    ravello_template_set(created_app, new_dhcp_path + '.poolStart', str(netip[0]))
-    ravello_template_set(created_app, new_dhcp_path + '.poolEnd', str(netip[-1]))
-    ravello_template_set(created_app, new_dhcp_path + '.ipConfigurationId', 
-            ravello_template_get(created_app, new_l3_nic_path + '.ipConfigurations.0.id'))
-    ravello_template_set(created_app, new_dhcp_path + '.gatewayIpConfigurationId', 
-            ravello_template_get(created_app, new_l3_nic_path + '.ipConfigurations.1.id'))
-    set_default_if_missing(created_app, 
+    set_default_if_missing(created_app,
             'design.network.services.dnsServers.0.ipConfigurationIds', [])
+    router_ip_config_ids = ravello_template_get(created_app,
+            'design.network.services.routers.0.ipConfigurationIds')
     dns_ip_config_ids = ravello_template_get(created_app,
             'design.network.services.dnsServers.0.ipConfigurationIds')
-    dns_ip_config_ids.append(ravello_template_get(created_app, 
-        new_l3_nic_path + '.ipConfigurations.0.id'))
-    ravello_template_set(created_app, new_dhcp_path + '.dnsIpConfigurationId', 
-            ravello_template_get(created_app, new_l3_nic_path + '.ipConfigurations.0.id'))
-    client.update_application(created_app)
+    for netip, switch_path, l3_nic_path in \
+            zip(netlist, switch_paths, l3_nic_paths):
+        dns_ip_config_id = ravello_template_get(created_app,
+                l3_nic_path + '.ipConfigurations.0.id')
+        gateway_ip_config_id = ravello_template_get(created_app,
+                l3_nic_path + '.ipConfigurations.1.id')
+        router_ip_config_ids.append(gateway_ip_config_id)
+        if 'ports' not in ravello_template_get(created_app, switch_path):
+            ravello_template_set(created_app, switch_path + '.ports', [])
+        create_port_on_switch(created_app, switch_path,
+                ravello_template_get(created_app, l3_nic_path + '.id'),
+                'SERVICES')
+        new_dhcp_path = path_for_next_item(created_app,
+                'design.network.services.dhcpServers')
+        ravello_template_set(created_app, new_dhcp_path + '.mask', str(netip.netmask))
+        ravello_template_set(created_app, new_dhcp_path + '.poolStart', str(netip[0]))
+        ravello_template_set(created_app, new_dhcp_path + '.poolEnd', str(netip[-1]))
+        ravello_template_set(created_app, new_dhcp_path + '.ipConfigurationId',
+                dns_ip_config_id)
+        ravello_template_set(created_app, new_dhcp_path + '.gatewayIpConfigurationId',
+                gateway_ip_config_id)
+        dns_ip_config_ids.append(dns_ip_config_id)
+        ravello_template_set(created_app, new_dhcp_path + '.dnsIpConfigurationId',
+                dns_ip_config_id)
+    app_docs.update(created_app)
 
-def delete_autogenerated_subnet(client, module, appID):
-    created_app = client.get_application(appID)
+def clear_autogenerated_network(created_app):
     ravello_template_set(created_app, 'design.network.switches', [])
     ravello_template_set(created_app, 'design.network.subnets', [])
     ravello_template_set(created_app, 'design.network.services.networkInterfaces', [])
     ravello_template_set(created_app, 'design.network.services.dhcpServers', [])
-    client.update_application(created_app)
-
-def create_port_on_switch(created_app, switch_path, device_id, device_type):
-    port_path = path_for_next_item(created_app,
-            switch_path + '.ports')
-    #ravello_template_set(created_app, port_path, {})
-    ravello_template_set(created_app,
-            port_path + '.deviceId',
-            device_id)
-    ravello_template_set(created_app,
-            port_path + '.deviceType',
-            device_type)
-    ravello_template_set(created_app,
-            port_path + '.index',
-            int(port_path.split('.')[-1]) + 1)
-    ravello_template_set(created_app,
-            port_path + '.networkSegmentReferences.0.networkSegmentId',
-            ravello_template_get(created_app,
-                switch_path + '.networkSegments.0.id'))
-    ravello_template_set(created_app,
-            port_path + '.networkSegmentReferences.0.anyNetworksegment',
-            False)
-    ravello_template_set(created_app,
-            port_path + '.networkSegmentReferences.0.egressPolicy',
-            'UNTAGGED')
-    return
-
-def path_for_next_item(app_json, jspath):
-    return jspath + '.' + str(len(ravello_template_get(app_json, jspath)))
-
-def path_from_ip(created_app, path_map, ip_addr):
-    for net_block, path in path_map.items():
-       if IPAddress(ip_addr) in IPNetwork(net_block):
-           return path 
-    raise Exception('no subnet for ip: ' + ip_addr + '...' + json.dumps(path_map))
-
-def create_dhcp_ip_map(created_app):
-    dhcp_servers = ravello_template_get(created_app,
-            'design.network.services.dhcpServers')
-    ip_index_map = {}
-    for i, dhcp in enumerate(dhcp_servers):
-        cidr_num = IPAddress(dhcp['mask']).netmask_bits()
-        net_block = dhcp['poolStart'] + '/' + str(cidr_num)
-        ip_index_map[net_block] =  \
-                'design.network.services.dhcpServers.' + str(i)
-    return ip_index_map
-
-def create_subnet_ip_map(created_app):
-    subnets = ravello_template_get(created_app,
-            'design.network.subnets')
-    ip_index_map = {}
-    for i, subnet in enumerate(subnets):
-        cidr_num = IPAddress(subnet['mask']).netmask_bits()
-        net_block = subnet['net'] + '/' + str(cidr_num)
-        ip_index_map[net_block] =  \
-                'design.network.subnets.' + str(i)
-    return ip_index_map
-
-def switch_path_from_ip(created_app, subnet_ip_map, ip_addr):
-    network_segment_id = ravello_template_get(created_app,
-        path_from_ip(created_app, subnet_ip_map, ip_addr) + '.networkSegmentId')
-    switches = ravello_template_get(created_app,
-        'design.network.switches')
-    for i, switch in enumerate(switches):
-        if switch['networkSegments'][0]['id'] == network_segment_id:
-          return 'design.network.switches.' + str(i)
-    raise Exception('Invalid network segment')
-
 
-def json_path_list_append(json_item, jspath, value):
-    item_list = ravello_template_get(json_item, jspath)
-    item_list.append(value)
-
-def update_app_with_internal_luids(client, module, app_request, appID):
+def update_app_with_internal_luids(client, module, app_request, appID,
+        app_docs=None):
+    app_docs = app_docs or RavelloAppDocuments(client)
     # update vms with ravello auto-gen'd luids
-    created_app = client.get_application(appID)
-    reserved_entries = []
-    hostname_ip_mapping = {}
-    dhcp_ip_mapping = create_dhcp_ip_map(created_app)
-    original_subnet_config_ids = ravello_template_get(created_app,
-            'design.network.subnets.0.ipConfigurationIds')
-    original_switch_ports = ravello_template_get(created_app,
-            'design.network.switches.0.ports')
-    subnet_ip_mapping = create_subnet_ip_map(created_app)
-    for dhcp in created_app['design']['network']['services']['dhcpServers']:
-        if 'reservedIpEntries' not in dhcp:
-            dhcp['reservedIpEntries'] = []
-    for vm in app_request['design']['vms']:
-        hostname = vm['hostnames'][0]
-        hostname_ip_mapping[hostname] = {}
-        for nic in vm['networkConnections']:
-            if check_item_exists(nic, 'ipConfig.autoIpConfig.reservedIp'):
-                hostname_ip_mapping[hostname][nic['name']] = \
-                      {'ip': nic['ipConfig']['autoIpConfig']['reservedIp'],
-                       'dhcpReservedIp': True}
-            elif check_item_exists(nic, 'ipConfig.staticIpConfig.ip'):
-                hostname_ip_mapping[hostname][nic['name']] = \
-                      {'ip': nic['ipConfig']['staticIpConfig']['ip'],
-                       'dhcpReservedIp': False}
-            else:
-                hostname_ip_mapping[hostname][nic['name']] = {'dhcpReservedIp': False}
-    for i, vm in enumerate(created_app['design']['vms']):
-        for nic in vm['networkConnections']:
-          nic_ipconf_id = nic['ipConfig']['id']
-          nic_id = nic['id']
-          nic_name = nic['name']
-          vm_hostname = vm['hostnames'][0]
-          hostname_ip_mapping[vm_hostname][nic_name]['ipconf_id'] = nic_ipconf_id
-          if nic_name in hostname_ip_mapping[vm_hostname] and \
-            'ip' in hostname_ip_mapping[vm_hostname][nic_name]:
-              nic_ip = hostname_ip_mapping[vm_hostname][nic_name]['ip']
-              if hostname_ip_mapping[vm_hostname][nic_name]['dhcpReservedIp']:
-                  item = {
-                         'ipConfigurationId': nic_ipconf_id,
-                          'ip': nic_ip
-                         }
-                  json_path_list_append(created_app,
-                          path_from_ip(created_app, 
-                              dhcp_ip_mapping,
-                              nic_ip) + '.reservedIpEntries',
-                          item)
-              switch_path = switch_path_from_ip(created_app, 
-                      subnet_ip_mapping,
-                      nic_ip) 
-              subnet_ipconfig_path = path_from_ip(created_app, 
-                      subnet_ip_mapping,
-                      nic_ip)
-          else:
-              switch_path = 'design.network.switches.0'
-              subnet_ipconfig_path = 'design.network.subnets.0'
-          json_path_list_append(created_app,
-                  subnet_ipconfig_path + '.ipConfigurationIds',
-                  nic_ipconf_id)
-          create_port_on_switch(created_app, 
-                  switch_path,
-                  nic_id,
-                  'VM')
-        if 'suppliedServices' in vm:
-            for j, svc in enumerate(vm ['suppliedServices']):
-                old_vm = list(filter(lambda v: v['hostnames'] == vm['hostnames'], 
-                                 app_request['design']['vms']))[0]
-                if check_item_exists(old_vm, 'suppliedServices.' + str(j)):
-                    service_req = ravello_template_get(old_vm['suppliedServices'], str(j))
-                    
-                    if 'device' in service_req:
-                        nic_name = service_req['device']
-                    elif 'ip' in service_req: 
-                         found = False
-                         for entry in hostname_ip_mapping[vm_hostname]:
-                             if service_req['ip'] == hostname_ip_mapping[vm_hostname][entry]['ip']:
-                                 found = True
-                                 nic_name = entry
-                                 break
-                         if not found:
-                             module_fail("ip not found: " + service_req['ip'] + \
-                                 "for " + vm_hostname + " " + nic_name + \
-                                 "                      " + \
-                                 json.dumps(hostname_ip_mapping))
-                if (nic_name not in hostname_ip_mapping[vm_hostname]):
-                    module_fail(nic_name + vm_hostname + "\n" + json.dumps(hostname_ip_mapping))
-                svc['useLuidForIpConfig'] = True
-                svc['ipConfigLuid'] = \
-                    hostname_ip_mapping[vm_hostname][nic_name]['ipconf_id']
-    client.update_application(created_app)
+    required = []
+    for i, vm in enumerate(app_request['design']['vms']):
+        for j, nic in enumerate(vm.get('networkConnections', [])):
+            nic_path = 'design.vms.%d.networkConnections.%d' % (i, j)
+            required += [nic_path + '.id', nic_path + '.ipConfig.id']
+    created_app = app_docs.get(appID, required)
+    reconcile_internal_luids(created_app, app_request)
+    app_docs.update(created_app)
 
-def detect_ips_and_and_create_compatible_subnets(client, module, appID, app_request):
-    net_list = []
+# Every address requested by a NIC, with the network it implies: a /16
+# around a DHCP reservation, the given mask around a static IP
+def requested_networks(app_request):
+    addresses = []
+    networks = []
     for vm in app_request['design']['vms']:
         for nic in vm['networkConnections']:
             if check_item_exists(nic, 'ipConfig.autoIpConfig.reservedIp'):
                 ip = nic['ipConfig']['autoIpConfig']['reservedIp']
-                subnet_exists = False
-                for net in net_list:
-                   if ip in net:
-                       subnet_exists = True
-                if not subnet_exists:
-                    new_net = IPNetwork(ip + '/16')
-                    net_list.append(new_net)
+                networks.append(IPNetwork(ip + '/16').cidr)
             elif check_item_exists(nic, 'ipConfig.staticIpConfig.ip'):
-                    '.'.join(nic['ipConfig']['staticIpConfig']['ip'].split('.')[:-3])
-    # Remove the Ravello auto-generated subnet
-    if len(net_list) == 0:
-        create_subnet_with_ip_pool(client, module, appID, IPNetwork('192.168.0.0/16'))
-    else:
-        for net in net_list:
-            create_subnet_with_ip_pool(client, module, appID, net)
+                ip = nic['ipConfig']['staticIpConfig']['ip']
+                mask = nic['ipConfig']['staticIpConfig'].get('mask', '255.255.0.0')
+                networks.append(IPNetwork(ip + '/' + mask).cidr)
+            else:
+                continue
+            addresses.append(ip)
+    return addresses, networks
+
+# Returns the sorted, non-overlapping subnets to create for app_request.
+# Declared subnets are used as given once checked not to overlap and to
+# cover every requested address.  Otherwise each network implied by the
+# addresses is created, except those inside another one.  Adjacent
+# networks stay apart, joining them would put their NICs on one switch.
+def plan_subnets(app_request, declared=None):
+    addresses, networks = requested_networks(app_request)
+    if declared:
+        netlist = []
+        covered = IPSet()
+        for subnet in declared:
+            net = IPNetwork(subnet)
+            if not covered.isdisjoint(IPSet(net)):
+                raise Exception('Overlapping Subnets')
+            covered.add(net)
+            netlist.append(net)
+        uncovered = IPSet(addresses) - covered
+        if uncovered:
+            raise Exception('No subnet defined for ip: ' + \
+                    ', '.join(str(net) for net in uncovered.iter_cidrs()))
+        return sorted(netlist)
+    if not networks:
+        return [IPNetwork('192.168.0.0/16')]
+    netlist = []
+    # widest first, so any network containing another is already kept
+    for net in sorted(set(networks), key=lambda net: (net.prefixlen, net)):
+        if not any(net in kept for kept in netlist):
+            netlist.append(net)
+    return sorted(netlist)
 main()
@@ -4,6 +4,9 @@ import re
 import yaml
 import json
 import sys
+import time
+import tempfile
+import threading
 import random
 import string
 import os
@@ -11,18 +14,51 @@ import base64
 import getpass
 import logging
 import logging.handlers
+import hashlib
+import copy
+import collections
+import contextlib
+import itertools
+import bisect
+import fnmatch
+import functools
+import socket
+import struct
+
+try:
+    import fcntl
+    HAS_FCNTL = True
+except ImportError:
+    HAS_FCNTL = False
+
+try:
+    import asyncio
+    import queue
+    HAS_ASYNCIO = True
+except ImportError:
+    HAS_ASYNCIO = False
 
 
 class ModuleFail:
     def __init__(self):
         self.module = None
+        self.local = threading.local()
     def attach_ansible_modle(self, module):
         self.module = module
     def __call__(self, msg):
-        if (self.module == None):
+        if (self.module == None) or getattr(self.local, 'raising', False):
             raise Exception(msg)
         else:
             self.module.fail_json(msg=msg)
+    # Within the block, failures on this thread raise instead of exiting,
+    # so the caller can collect them
+    @contextlib.contextmanager
+    def raising(self):
+        self.local.raising = True
+        try:
+            yield
+        finally:
+            self.local.raising = False
 module_fail = ModuleFail()
 
 def maybe_digit(item):
@@ -32,23 +68,7 @@ def maybe_digit(item):
       return item
 
 def ravello_template_set(json_slice, jspath_str, value):
-    jspath = re.split(r'(?<!\\)\.', jspath_str)
-    def recur (json_slice, jspath, value):
-        if len(jspath) > 1:
-            if not json_head_contains(json_slice, maybe_digit(jspath[0])):
-                if jspath[1].isdigit():
-                    json_slice = json_insert_head(json_slice, maybe_digit(jspath[0]), [])
-                else:
-                    json_slice = json_insert_head(json_slice, maybe_digit(jspath[0]), {})
-            json_insert_head(json_slice, maybe_digit(jspath[0]),
-                        recur(json_slice[maybe_digit(jspath[0])], 
-                            jspath[1:], value))
-        elif len(jspath) == 1:
-            json_slice = json_insert_head(json_slice, maybe_digit(jspath[0]), value)
-        else:
-            raise Exception("Error: invalid json path string: " + jspath_str)
-        return json_slice
-    return recur(json_slice, jspath, value)
+    return compile_json_path(jspath_str).set(json_slice, value)
 def json_insert_head(json_slice, key, value):
     if type(key) is int:
         if len(json_slice) <= key:
@@ -90,32 +110,1136 @@ def json_head_contains(json_item, key):
         return (key in json_item)
 
 def ravello_template_get(json_item, jspath_str, **kwargs):
-    jspath = re.split(r'(?<!\\)\.', jspath_str)
-    def recur(json_slice, jspath):
-        if len(jspath) > 1:
-            if not json_head_contains(json_slice, maybe_digit(jspath[0])):
-                raise Exception("error: invalid json_path string: " + jspath_str)
-            return recur(json_slice[maybe_digit(jspath[0])], jspath[1:])
-        elif len(jspath) == 1:
-            if not json_head_contains(json_slice, maybe_digit(jspath[0])):
-                raise Exception("error: invalid json_path string: " + jspath_str)
-            else:
-                return json_slice[maybe_digit(jspath[0])]
-        else:
-            raise exception("error: invalid json_path string: " + jspath_str)
-    return recur(json_item, jspath)
+    return compile_json_path(jspath_str).get(json_item)
 
 def json_path_contains(json_item, jspath):
-    def recur(json_slice, split_path):
-        if len(split_path) > 1:
-            if not json_head_contains(json_slice, maybe_digit(split_path[0])):
-                return False
-            return recur(json_slice[maybe_digit(split_path[0])], split_path[1:])
-        elif len(split_path) == 1:
-            if not json_head_contains(json_slice, maybe_digit(split_path[0])):
+    return compile_json_path(jspath).lookup(json_item)[0]
+
+class JsonPath(object):
+    '''
+    A dotted json path ('design.vms.0.name', dots escaped with a backslash
+    are kept in the key) split once into its keys.  Digit keys index lists.
+    '''
+    def __init__(self, jspath_str):
+        self.path = jspath_str
+        self.keys = [maybe_digit(key) for key in re.split(r'(?<!\\)\.', jspath_str)]
+
+    def lookup(self, json_item):
+        ''' Returns (True, value) if the path exists, else (False, None) '''
+        json_slice = json_item
+        for key in self.keys:
+            if not json_head_contains(json_slice, key):
+                return False, None
+            json_slice = json_slice[key]
+        return True, json_slice
+
+    def get(self, json_item, *default):
+        ''' Returns the value at the path, or default if given and the
+        path does not exist '''
+        found, value = self.lookup(json_item)
+        if found:
+            return value
+        if default:
+            return default[0]
+        raise Exception("error: invalid json_path string: " + self.path)
+
+    def set(self, json_item, value):
+        ''' Sets the value at the path, creating the lists and dicts on
+        the way, and returns json_item '''
+        json_slice = json_item
+        for key, next_key in zip(self.keys, self.keys[1:]):
+            if not json_head_contains(json_slice, key):
+                json_insert_head(json_slice, key,
+                        [] if type(next_key) is int else {})
+            json_slice = json_slice[key]
+        json_insert_head(json_slice, self.keys[-1], value)
+        return json_item
+
+# Compiled paths, most recently used last.  Paths are mostly built from a
+# few templates, so a bounded cache keeps nearly all of them.
+JSON_PATH_CACHE_SIZE = 1024
+json_path_cache = collections.OrderedDict()
+json_path_cache_lock = threading.Lock()
+
+def compile_json_path(jspath_str):
+    with json_path_cache_lock:
+        path = json_path_cache.pop(jspath_str, None)
+        if path is None:
+            path = JsonPath(jspath_str)
+            if len(json_path_cache) >= JSON_PATH_CACHE_SIZE:
+                json_path_cache.popitem(last=False)
+        json_path_cache[jspath_str] = path
+    return path
+
+
+
+##### Local Caches #####
+
+def ravello_cache_dir():
+    return os.path.expanduser(
+        os.environ.get('RAVELLO_CACHE_DIR', '~/.ravello_cache'))
+
+# Replace path with data without readers ever seeing a partial file.
+# Files are created private to the user since they may describe the account.
+def atomic_write(path, data):
+    cache_dir = os.path.dirname(path)
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir, 0o700)
+    fd, tmp_path = tempfile.mkstemp(dir=cache_dir,
+            prefix='.' + os.path.basename(path) + '-')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            f.write(data)
+        os.rename(tmp_path, path)
+    except Exception:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+class FileLock(object):
+    '''
+    Exclusive advisory lock, held for the duration of a with block, so that
+    parallel Ansible forks can share a cache file.  A no-op without fcntl.
+    '''
+    def __init__(self, path):
+        self.path = path
+        self.fd = None
+
+    def __enter__(self):
+        lock_dir = os.path.dirname(self.path)
+        if not os.path.isdir(lock_dir):
+            os.makedirs(lock_dir, 0o700)
+        self.fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+        if HAS_FCNTL:
+            fcntl.flock(self.fd, fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, *exc_info):
+        if HAS_FCNTL:
+            fcntl.flock(self.fd, fcntl.LOCK_UN)
+        os.close(self.fd)
+        self.fd = None
+
+# return the parsed json in path, or default if it is missing or unreadable
+def read_json_file(path, default):
+    try:
+        with open(path, 'r') as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError):
+        return default
+
+def name_filter(name):
+    return {
+        'type': 'COMPLEX',
+        'operator': 'And',
+        'criteria': [{
+            'type': 'SIMPLE',
+            'operator': 'Equals',
+            'propertyName': 'name',
+            'operand': name
+        }]
+    }
+
+def is_name_glob(name):
+    return any(c in name for c in '*?[')
+
+# The HTTP status of an SDK error, None if it has no response
+def http_status(error):
+    response = getattr(error, 'response', None)
+    return getattr(response, 'status_code', getattr(response, 'status', None))
+
+# The API url and username of the account a client works on
+def client_account(client, username=None):
+    # RavelloClient.url is the parsed url
+    url = getattr(client, 'url', None) or ''
+    if hasattr(url, 'geturl'):
+        url = url.geturl()
+    if username is None:
+        username = getattr(client, '_username', None) or ''
+    return url + '\n' + username
+
+class RavelloNameIndex(object):
+    '''
+    Persistent map of application, blueprint and image names to IDs, in
+    one file per account (see client_account).
+
+    A name seen less than max_age seconds ago resolves without an API call.
+    Older or unknown names are revalidated with a server side name filter,
+    falling back to one full listing which re-indexes every name of that
+    kind.  Names compare case-insensitively, like the module always has.
+    '''
+    # kind -> (SDK listing method, filter endpoint)
+    KINDS = {
+        'application': ('get_applications', '/applications/filter'),
+        'blueprint': ('get_blueprints', '/blueprints/filter'),
+        'image': ('get_images', '/images/filter'),
+    }
+
+    def __init__(self, account='', path=None, max_age=3600):
+        self.path = path or os.path.join(ravello_cache_dir(), 'names-%s.json'
+                % hashlib.sha1(account.encode('utf-8')).hexdigest())
+        self.max_age = max_age
+        self.entries = read_json_file(self.path, {})
+        # the inventory resolves names from several threads
+        self.lock = threading.RLock()
+
+    def save(self):
+        with self.lock:
+            atomic_write(self.path, json.dumps(self.entries))
+
+    def remember(self, kind, name, item_id):
+        with self.lock:
+            self.entries.setdefault(kind, {})[name.lower()] = \
+                    {'id': item_id, 'time': time.time()}
+            self.save()
+
+    def forget(self, kind, name):
+        with self.lock:
+            if self.entries.get(kind, {}).pop(name.lower(), None) is not None:
+                self.save()
+
+    def cached(self, kind, name):
+        entry = self.entries.get(kind, {}).get(name.lower())
+        if entry is None or entry['time'] + self.max_age < time.time():
+            return None
+        return entry['id']
+
+    def lookup(self, client, kind, name):
+        ''' Returns the ID of the named item, or None if it does not exist '''
+        item_id = self.cached(kind, name)
+        if item_id is not None:
+            return item_id
+        item = self.find(client, kind, name)
+        return item['id'] if item else None
+
+    def find(self, client, kind, name):
+        ''' Returns the listing entry of the named item from the API '''
+        filter_path = self.KINDS[kind][1]
+        try:
+            items = client.request('POST', filter_path, name_filter(name))
+        except Exception:
+            items = None
+        if items:
+            self.remember(kind, name, items[0]['id'])
+            return items[0]
+        # No exact match (or no filter support): index the full listing
+        for item in self.index_listing(client, kind):
+            if item['name'].lower() == name.lower():
+                return item
+        return None
+
+    def index_listing(self, client, kind):
+        ''' Fetches the full listing of kind, re-indexes every name in it
+        and returns it '''
+        list_method = self.KINDS[kind][0]
+        now = time.time()
+        items = getattr(client, list_method)()
+        kind_entries = {}
+        for item in items:
+            kind_entries[item['name'].lower()] = {'id': item['id'], 'time': now}
+        with self.lock:
+            self.entries[kind] = kind_entries
+            self.save()
+        return items
+
+    def match(self, client, kind, patterns):
+        '''
+        Resolves names and shell style globs to {'id', 'name'} entries,
+        each item once, in the order given.  Names resolve like lookup,
+        globs match case-insensitively against one full listing.  Returns
+        the entries and the names that were not found.
+        '''
+        found = []
+        missing = []
+        seen = set()
+        listing = None
+        for pattern in patterns:
+            if is_name_glob(pattern):
+                if listing is None:
+                    listing = self.index_listing(client, kind)
+                items = [item for item in listing if fnmatch.fnmatchcase(
+                        item['name'].lower(), pattern.lower())]
+            else:
+                item_id = self.lookup(client, kind, pattern)
+                if item_id is None:
+                    missing.append(pattern)
+                    continue
+                items = [{'id': item_id, 'name': pattern}]
+            for item in items:
+                if item['id'] not in seen:
+                    seen.add(item['id'])
+                    found.append({'id': item['id'], 'name': item['name']})
+        return found, missing
+
+    def call_with_id(self, client, kind, name, fn):
+        '''
+        Calls fn with the ID of the named item.  If the ID came from the
+        index and fn fails with a 404, the entry is stale, so it is
+        resolved again from the API and fn retried once.  Any other error
+        is raised as is, since fn may already have acted.
+        '''
+        from_index = self.cached(kind, name) is not None
+        item_id = self.lookup(client, kind, name)
+        if item_id is None:
+            raise Exception('Could not find %s: %s' % (kind, name))
+        try:
+            return fn(item_id)
+        except Exception as e:
+            if not from_index or http_status(e) != 404:
+                raise
+            self.forget(kind, name)
+            item_id = self.lookup(client, kind, name)
+            if item_id is None:
+                raise Exception('Could not find %s: %s' % (kind, name))
+            return fn(item_id)
+
+
+class RavelloImageCatalog(object):
+    '''
+    The disk image catalog of the account, fetched with one listing and
+    indexed by ID and by name.  Names match exactly first, then
+    case-insensitively.  With max_age > 0 the listing is also saved, in
+    one file per account like RavelloNameIndex, and reused by later runs
+    for max_age seconds; a miss on a saved listing fetches it again before
+    giving up.
+    '''
+    def __init__(self, client, path=None, max_age=0):
+        self.client = client
+        self.path = path or os.path.join(ravello_cache_dir(),
+                'diskimages-%s.json' % hashlib.sha1(
+                    client_account(client).encode('utf-8')).hexdigest())
+        self.max_age = max_age
+        self.by_id = None
+        self.by_name = None
+        self.by_lower_name = None
+        self.from_file = False
+        self.full = {}
+
+    def index(self, images):
+        self.by_id = {}
+        self.by_name = {}
+        self.by_lower_name = {}
+        for image in images:
+            self.by_id.setdefault(str(image['id']), image)
+            self.by_name.setdefault(image['name'], image)
+            self.by_lower_name.setdefault(image['name'].lower(), image)
+
+    def load(self, refresh=False):
+        if self.by_id is not None and not refresh:
+            return
+        if self.max_age > 0 and not refresh:
+            saved = read_json_file(self.path, None)
+            if saved and saved['time'] + self.max_age >= time.time():
+                self.index(saved['images'])
+                self.from_file = True
+                return
+        images = self.client.get_diskimages()
+        self.index(images)
+        self.from_file = False
+        if self.max_age > 0:
+            atomic_write(self.path, json.dumps(
+                {'time': time.time(), 'images': images}))
+
+    def lookup(self, name_or_id):
+        key = str(name_or_id)
+        return self.by_id.get(key) or self.by_name.get(key) or \
+                self.by_lower_name.get(key.lower())
+
+    def find(self, name_or_id):
+        ''' Returns the disk image with this ID or name, or None '''
+        self.load()
+        image = self.lookup(name_or_id)
+        if image is None and self.from_file:
+            self.load(refresh=True)
+            image = self.lookup(name_or_id)
+        if image is None or 'size' in image:
+            return image
+        # the listing lacks the size, load the image itself once
+        if image['id'] not in self.full:
+            self.full[image['id']] = self.client.get_diskimage(image['id'])
+        return self.full[image['id']]
+
+
+class RavelloMetadataCache(object):
+    '''
+    Account metadata that rarely changes, such as cost buckets and
+    blueprint publish locations, kept in metadata.json for a TTL per kind
+    of resource.  The file is locked while an entry is read, fetched and
+    written, so parallel Ansible forks make one request between them.
+    invalidate drops entries after our own create or delete calls.
+    Entries are kept per account.  When disabled, get always fetches.
+    '''
+    TTLS = {
+        'cost_buckets': 3600,
+        'publish_locations': 3600,
+    }
+
+    def __init__(self, account='', path=None, ttls=None, enabled=True):
+        self.path = path or os.path.join(ravello_cache_dir(), 'metadata.json')
+        self.account = hashlib.sha1(account.encode('utf-8')).hexdigest()
+        self.ttls = dict(self.TTLS)
+        self.ttls.update(ttls or {})
+        self.enabled = enabled
+
+    def get(self, resource, key, fetch):
+        if not self.enabled or self.ttls.get(resource, 0) <= 0:
+            return fetch()
+        key = str(key)
+        with FileLock(self.path + '.lock'):
+            entries = read_json_file(self.path, {})
+            entry = entries.get(self.account, {}).get(resource, {}).get(key)
+            if entry and entry['time'] + self.ttls[resource] >= time.time():
+                return entry['value']
+            value = fetch()
+            entries.setdefault(self.account, {}).setdefault(resource, {})[key] = \
+                {'time': time.time(), 'value': value}
+            atomic_write(self.path, json.dumps(entries))
+            return value
+
+    def invalidate(self, resource, key=None):
+        if not os.path.exists(self.path):
+            return
+        with FileLock(self.path + '.lock'):
+            entries = read_json_file(self.path, {})
+            resources = entries.get(self.account, {})
+            if resource not in resources:
+                return
+            if key is None:
+                del resources[resource]
+            elif resources[resource].pop(str(key), None) is None:
+                return
+            atomic_write(self.path, json.dumps(entries))
+
+
+##### Polling #####
+
+# Delays between polls: short at first, then growing by factor up to
+# maximum, each varied by +/- jitter so parallel waits do not poll the
+# API in step
+def poll_intervals(initial=2.0, factor=1.5, maximum=10.0, jitter=0.2):
+    interval = initial
+    while True:
+        yield interval * random.uniform(1 - jitter, 1 + jitter)
+        interval = min(interval * factor, maximum)
+
+def poll_until(check, timeout, intervals=None):
+    '''
+    Calls check right away, then after each delay of intervals, until it
+    returns true or timeout seconds have passed.  Returns whether check
+    succeeded.  Exceptions from check are not caught.
+    '''
+    intervals = intervals or poll_intervals()
+    deadline = time.time() + timeout
+    while True:
+        if check():
+            return True
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            return False
+        time.sleep(min(next(intervals), remaining))
+
+class WaitMultiplexer(object):
+    '''
+    Waits for many items, such as app or VM IDs, to become ready from one
+    event loop on one shared poll schedule.  check(item) is a blocking
+    call, returning true once the item is ready and raising should it
+    never become ready; each round checks every pending item on up to
+    workers threads.  Without asyncio (Python 2) the rounds run on a
+    thread pool instead.
+    '''
+    def __init__(self, check, workers=8, intervals=None):
+        self.check = check
+        self.workers = max(1, workers or 1)
+        self.intervals = intervals or poll_intervals()
+
+    def wait(self, items, timeout):
+        ''' Returns the ready items, a dict of failed items to their
+        exception and the items still pending at timeout '''
+        self.pending = list(items)
+        self.ready = []
+        self.failed = {}
+        if self.pending:
+            if HAS_ASYNCIO:
+                self.wait_on_loop(timeout)
+            else:
+                self.wait_on_pool(timeout)
+        return self.ready, self.failed, self.pending
+
+    def checked(self, item):
+        try:
+            return bool(self.check(item))
+        except Exception as e:
+            return e
+
+    def record(self, items, outcomes):
+        for item, outcome in zip(items, outcomes):
+            if isinstance(outcome, Exception):
+                self.failed[item] = outcome
+            elif outcome:
+                self.ready.append(item)
+            else:
+                continue
+            self.pending.remove(item)
+
+    def wait_on_loop(self, timeout):
+        # new_event_loop logs at DEBUG, which ravello_module's byte buffer
+        # capture of the root logger cannot take
+        asyncio_log = logging.getLogger('asyncio')
+        level = asyncio_log.level
+        asyncio_log.setLevel(max(level, logging.WARNING))
+        loop = asyncio.new_event_loop()
+        deadline = loop.time() + timeout
+        outstanding = []
+        queued = queue.Queue()
+        over = threading.Event()
+        # checks run on daemon threads, so a hung one holds neither the
+        # wait past its timeout nor the interpreter at exit
+        def work():
+            while True:
+                item = queued.get()
+                if over.is_set():
+                    return
+                outcome = self.checked(item)
+                try:
+                    loop.call_soon_threadsafe(checked, item, outcome)
+                except RuntimeError:
+                    # the loop closed while this check ran
+                    return
+        for _ in range(min(self.workers, len(self.pending))):
+            thread = threading.Thread(target=work)
+            thread.daemon = True
+            thread.start()
+        def start_round():
+            outstanding[:] = list(self.pending)
+            for item in outstanding:
+                queued.put(item)
+        # outcomes are recorded as they come, so a slow check only holds
+        # up the next round
+        def checked(item, outcome):
+            self.record([item], [outcome])
+            outstanding.remove(item)
+            if outstanding:
+                return
+            remaining = deadline - loop.time()
+            if not self.pending or remaining <= 0:
+                loop.stop()
+            else:
+                loop.call_later(min(next(self.intervals), remaining), start_round)
+        loop.call_soon(start_round)
+        loop.call_at(deadline + 1, loop.stop)
+        try:
+            loop.run_forever()
+        finally:
+            over.set()
+            # wake idle workers so they exit
+            for _ in range(self.workers):
+                queued.put(None)
+            loop.close()
+            asyncio_log.setLevel(level)
+
+    def wait_on_pool(self, timeout):
+        from multiprocessing.pool import ThreadPool
+        pool = ThreadPool(min(self.workers, len(self.pending)))
+        def check_round():
+            items = list(self.pending)
+            self.record(items, pool.map(self.checked, items))
+            return not self.pending
+        try:
+            poll_until(check_round, timeout, self.intervals)
+        finally:
+            pool.close()
+            pool.join()
+
+
+##### Service Reachability #####
+
+# Whether host:port accepts a TCP connection and, given search_regex (a
+# compiled pattern), sends a banner matching it within timeout seconds
+def probe_tcp_service(host, port, timeout=5.0, search_regex=None):
+    try:
+        sock = socket.create_connection((host, port), timeout)
+    except (socket.error, socket.timeout):
+        return False
+    try:
+        if search_regex is None:
+            return True
+        data = b''
+        while len(data) < 4096:
+            chunk = sock.recv(1024)
+            if not chunk:
                 return False
+            data += chunk
+            if search_regex.search(data.decode('utf-8', 'replace')):
+                return True
+        return False
+    except (socket.error, socket.timeout):
+        return False
+    finally:
+        sock.close()
+
+def wait_for_services(services, timeout, search_regex=None, workers=16):
+    '''
+    Probes every (host, port) of services concurrently until each accepts
+    connections, or timeout seconds have passed.  Returns the reachable
+    services and those still unreachable.  An invalid search_regex raises
+    re.error before any probe.
+    '''
+    if search_regex is not None:
+        search_regex = re.compile(search_regex)
+    waiter = WaitMultiplexer(
+            lambda service: probe_tcp_service(service[0], service[1],
+                search_regex=search_regex),
+            workers, poll_intervals(initial=1.0, maximum=5.0))
+    ready, failed, pending = waiter.wait(services, timeout)
+    return ready, pending + list(failed)
+
+
+##### Session Cache #####
+
+# Only the HTTP status counts, the message may well contain 401 otherwise
+def is_unauthorized(error):
+    return http_status(error) == 401
+
+class RavelloSessionCache(object):
+    '''
+    Persists the session cookies of a logged in RavelloClient, so that later
+    tasks and inventory runs reuse the session instead of logging in again.
+    Sessions are keyed by API url and username (the password is never
+    stored) and reused for at most max_age seconds.
+    '''
+    def __init__(self, path=None, max_age=3600):
+        self.path = path or os.path.join(ravello_cache_dir(), 'sessions.json')
+        self.max_age = max_age
+
+    def key(self, client, username):
+        return hashlib.sha1(client_account(client, username).encode('utf-8')).hexdigest()
+
+    def login(self, client, username, password):
+        ''' Returns client wrapped in a SessionClient, logged in from the
+        cache when possible '''
+        with FileLock(self.path + '.lock'):
+            sessions = read_json_file(self.path, {})
+            entry = sessions.get(self.key(client, username))
+            if entry and entry['time'] + self.max_age > time.time():
+                set_client_cookies(client, entry['cookies'])
+                # lets the SDK log in again should the session be expired
+                if hasattr(client, '_password'):
+                    client._username = username
+                    client._password = password
+            else:
+                client.login(username, password)
+                self.store(sessions, client, username)
+        return SessionClient(client, self, username, password)
+
+    def relogin(self, client, username, password):
+        with FileLock(self.path + '.lock'):
+            set_client_cookies(client, None)
+            client.login(username, password)
+            self.store(read_json_file(self.path, {}), client, username)
+
+    def save(self, client, username):
+        with FileLock(self.path + '.lock'):
+            self.store(read_json_file(self.path, {}), client, username)
+
+    def store(self, sessions, client, username):
+        # called with the lock held
+        cookies = get_client_cookies(client)
+        if cookies is None:
+            return
+        now = time.time()
+        for key in list(sessions):
+            if sessions[key]['time'] + self.max_age <= now:
+                del sessions[key]
+        sessions[self.key(client, username)] = {'cookies': cookies, 'time': now}
+        atomic_write(self.path, json.dumps(sessions))
+
+# RavelloClient keeps its session in the requests.Session at _connection,
+# and counts as logged in while there is one
+def get_client_cookies(client):
+    connection = getattr(client, '_connection', None)
+    if connection is None:
+        return None
+    return dict(connection.cookies.items())
+
+def set_client_cookies(client, cookies):
+    if cookies is None:
+        client._connection = None
+        return
+    import requests
+    connection = requests.Session()
+    connection.proxies = getattr(client, '_proxies', {})
+    connection.stream = True
+    connection.cookies = requests.utils.cookiejar_from_dict(cookies)
+    client._connection = connection
+
+class SessionClient(object):
+    '''
+    Delegates to a RavelloClient, logging in again through the session
+    cache and retrying once when a call fails with 401 Unauthorized.  When
+    the SDK logged in again by itself during a call, the new session is
+    saved to the cache.
+    '''
+    def __init__(self, client, session_cache, username, password):
+        self._client = client
+        self._session_cache = session_cache
+        self._username = username
+        self._password = password
+
+    def __getattr__(self, name):
+        attr = getattr(self._client, name)
+        if not callable(attr):
+            return attr
+        def call(*args, **kwargs):
+            cookies = get_client_cookies(self._client)
+            try:
+                result = attr(*args, **kwargs)
+            except Exception as e:
+                if not is_unauthorized(e):
+                    raise
+                self._session_cache.relogin(self._client,
+                        self._username, self._password)
+                return attr(*args, **kwargs)
+            if get_client_cookies(self._client) != cookies:
+                self._session_cache.save(self._client, self._username)
+            return result
+        return call
+
+
+##### Metrics #####
+
+class RunMetrics(object):
+    '''
+    Wall time of each phase of a task and the latency of every API call
+    made through a client wrapped by wrap(), reported by as_dict() in the
+    module result.  Calls are tagged with the phase they were made in.  A
+    task failing within a phase reports that phase up to the failure.
+    '''
+    def __init__(self):
+        self.start = time.time()
+        self.phases = collections.OrderedDict()
+        self.api_calls = []
+        self.current = None
+        self.current_start = None
+        self.lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        self.current = name
+        self.current_start = start = time.time()
+        try:
+            yield
+        finally:
+            self.phases[name] = self.phases.get(name, 0) + time.time() - start
+            self.current = None
+
+    def record(self, method, seconds, failed=False):
+        call = {'method': method, 'phase': self.current,
+                'seconds': round(seconds, 3)}
+        if failed:
+            call['failed'] = True
+        with self.lock:
+            self.api_calls.append(call)
+
+    def wrap(self, client):
+        return MetricsClient(client, self)
+
+    def as_dict(self):
+        with self.lock:
+            api_calls = list(self.api_calls)
+        now = time.time()
+        phases = dict(self.phases)
+        if self.current is not None:
+            phases[self.current] = phases.get(self.current, 0) + \
+                    now - self.current_start
+        return {
+            'seconds': round(now - self.start, 3),
+            'phases': dict((name, round(seconds, 3))
+                           for name, seconds in phases.items()),
+            'api_calls': api_calls,
+        }
+
+class MetricsClient(object):
+    '''
+    Delegates to a RavelloClient, timing each call into a RunMetrics.
+    '''
+    def __init__(self, client, metrics):
+        self._client = client
+        self._metrics = metrics
+
+    def __getattr__(self, name):
+        attr = getattr(self._client, name)
+        if not callable(attr):
+            return attr
+        def call(*args, **kwargs):
+            start = time.time()
+            try:
+                result = attr(*args, **kwargs)
+            except Exception:
+                self._metrics.record(name, time.time() - start, failed=True)
+                raise
+            self._metrics.record(name, time.time() - start)
+            return result
+        return call
+
+
+##### Application Documents #####
+
+class RavelloAppDocuments(object):
+    '''
+    Per-run write-through cache of application documents.
+
+    The document returned by create_application and update_application
+    replaces the cached one, so reading an app right after changing it
+    costs no request.  get refetches when the app is not cached or when
+    one of the required json paths, typically IDs assigned by Ravello,
+    is missing from the cached document.  Documents are returned as
+    cached, callers change them in place and pass them to update.
+    '''
+    def __init__(self, client):
+        self.client = client
+        self.docs = {}
+
+    def store(self, doc):
+        if isinstance(doc, dict) and 'id' in doc and 'design' in doc:
+            self.docs[doc['id']] = doc
             return True
-        else:
-            raise Exception("Error: invalid json path string")
-    return recur(json_item, re.split(r'(?<!\\)\.', jspath))
+        return False
+
+    def drop(self, app_id):
+        self.docs.pop(app_id, None)
+
+    def get(self, app_id, required=()):
+        doc = self.docs.get(app_id)
+        if doc is None or \
+                not all(json_path_contains(doc, path) for path in required):
+            doc = self.client.get_application(app_id)
+            self.store(doc)
+        return doc
+
+    def create(self, app):
+        doc = self.client.create_application(app)
+        self.store(doc)
+        return doc
+
+    def update(self, doc):
+        app_id = doc['id']
+        try:
+            updated = self.client.update_application(doc)
+        except Exception:
+            self.drop(app_id)
+            raise
+        if not self.store(updated):
+            # the caller changed the cached document, it is not current
+            self.drop(app_id)
+        return updated
+
+
+##### Offline Planning #####
+
+class PlanClient(object):
+    '''
+    Local model of the Ravello API for planning a design without an
+    account.  It implements the calls the design state makes, assigns IDs
+    to new applications and network items the way Ravello does on update,
+    and records every call in order in calls.  The account is taken to be
+    empty, and images are not checked, so offline is set for callers that
+    would otherwise look them up.
+    '''
+    offline = True
+    # items Ravello gives an id to, by the key of the list holding them
+    ID_LISTS = ('vms', 'networkConnections', 'switches', 'networkSegments',
+        'subnets', 'networkInterfaces', 'ipConfigurations', 'dhcpServers',
+        'routers', 'dnsServers')
+
+    def __init__(self):
+        self.ids = itertools.count(1)
+        self.apps = {}
+        self.deleted = set()
+        self.calls = []
+
+    def record(self, method, target=None):
+        call = {'method': method}
+        if target is not None:
+            call['target'] = target
+        self.calls.append(call)
+
+    def assign_ids(self, node, key=None):
+        if isinstance(node, dict):
+            if key in self.ID_LISTS or key == 'ipConfig':
+                node.setdefault('id', next(self.ids))
+            if key == 'subnets':
+                node.setdefault('ipConfigurationIds', [])
+            for k, v in node.items():
+                self.assign_ids(v, k)
+        elif isinstance(node, list):
+            for v in node:
+                self.assign_ids(v, key)
+
+    def get_applications(self, filter=None):
+        self.record('get_applications', filter)
+        apps = [app for app_id, app in self.apps.items()
+                if app_id not in self.deleted]
+        if filter:
+            apps = [app for app in apps
+                    if all(app.get(k) == v for k, v in filter.items())]
+        return copy.deepcopy(apps)
+
+    def get_blueprints(self, filter=None):
+        self.record('get_blueprints', filter)
+        return []
+
+    def request(self, method, path, entity=None):
+        self.record('request', '%s %s' % (method, path))
+        return []
+
+    def get_application(self, app, aspect=None):
+        app_id = app['id'] if isinstance(app, dict) else app
+        self.record('get_application', app_id)
+        if app_id not in self.apps or app_id in self.deleted:
+            raise Exception('Application %s does not exist' % app_id)
+        return copy.deepcopy(self.apps[app_id])
+
+    def create_application(self, app):
+        app = copy.deepcopy(app)
+        app['id'] = next(self.ids)
+        self.record('create_application', app.get('name'))
+        self.assign_ids(app)
+        self.apps[app['id']] = app
+        return copy.deepcopy(app)
+
+    def update_application(self, app):
+        self.record('update_application', app['id'])
+        if app['id'] not in self.apps or app['id'] in self.deleted:
+            raise Exception('Application %s does not exist' % app['id'])
+        app = copy.deepcopy(app)
+        self.assign_ids(app)
+        self.apps[app['id']] = app
+        return copy.deepcopy(app)
+
+    def delete_application(self, app):
+        app_id = app['id'] if isinstance(app, dict) else app
+        self.record('delete_application', app_id)
+        self.deleted.add(app_id)
+
+    def create_blueprint(self, blueprint):
+        self.record('create_blueprint', blueprint.get('blueprintName'))
+        bp_id = next(self.ids)
+        return {'id': bp_id, 'name': blueprint.get('blueprintName'),
+                '_href': '/blueprints/%d' % bp_id}
+
+
+##### Network Lookups #####
+
+def ipv4_to_int(ip):
+    return struct.unpack('!I', socket.inet_aton(ip))[0]
+
+def int_to_ipv4(value):
+    return socket.inet_ntoa(struct.pack('!I', value))
+
+def netmask_bits(mask):
+    return bin(ipv4_to_int(mask)).count('1')
+
+class CidrTable(object):
+    '''
+    IPv4 networks mapped to values, kept sorted by first address so an
+    address resolves with one bisect instead of a scan of every network.
+    Networks must not overlap, as Ravello subnets cannot.
+    '''
+    def __init__(self):
+        self.starts = []
+        self.entries = []
+
+    def add(self, net, mask_bits, value):
+        size = 1 << (32 - mask_bits)
+        start = ipv4_to_int(net) & ~(size - 1) & 0xffffffff
+        i = bisect.bisect_left(self.starts, start)
+        self.starts.insert(i, start)
+        self.entries.insert(i, (start + size - 1, mask_bits, value))
+
+    def lookup(self, ip, default=None):
+        address = ipv4_to_int(ip)
+        i = bisect.bisect_right(self.starts, address) - 1
+        if i >= 0 and address <= self.entries[i][0]:
+            return self.entries[i][2]
+        return default
+
+    def items(self):
+        return [('%s/%d' % (int_to_ipv4(start), entry[1]), entry[2])
+                for start, entry in zip(self.starts, self.entries)]
+
+    def __len__(self):
+        return len(self.starts)
+
+
+##### Network Design #####
+
+def create_port_on_switch(created_app, switch_path, device_id, device_type):
+    port_path = path_for_next_item(created_app,
+            switch_path + '.ports')
+    #ravello_template_set(created_app, port_path, {})
+    ravello_template_set(created_app,
+            port_path + '.deviceId',
+            device_id)
+    ravello_template_set(created_app,
+            port_path + '.deviceType',
+            device_type)
+    ravello_template_set(created_app,
+            port_path + '.index',
+            int(port_path.split('.')[-1]) + 1)
+    ravello_template_set(created_app,
+            port_path + '.networkSegmentReferences.0.networkSegmentId',
+            ravello_template_get(created_app,
+                switch_path + '.networkSegments.0.id'))
+    ravello_template_set(created_app,
+            port_path + '.networkSegmentReferences.0.anyNetworksegment',
+            False)
+    ravello_template_set(created_app,
+            port_path + '.networkSegmentReferences.0.egressPolicy',
+            'UNTAGGED')
+    return
+
+def path_for_next_item(app_json, jspath):
+    return jspath + '.' + str(len(ravello_template_get(app_json, jspath)))
+
+def path_from_ip(created_app, path_map, ip_addr):
+    path = path_map.lookup(ip_addr)
+    if path is None:
+        raise Exception('no subnet for ip: ' + ip_addr + '...' + \
+                json.dumps(dict(path_map.items())))
+    return path
+
+def create_dhcp_ip_map(created_app):
+    dhcp_servers = ravello_template_get(created_app,
+            'design.network.services.dhcpServers')
+    ip_index_map = CidrTable()
+    for i, dhcp in enumerate(dhcp_servers):
+        ip_index_map.add(dhcp['poolStart'], netmask_bits(dhcp['mask']),
+                'design.network.services.dhcpServers.' + str(i))
+    return ip_index_map
+
+def create_subnet_ip_map(created_app):
+    subnets = ravello_template_get(created_app,
+            'design.network.subnets')
+    ip_index_map = CidrTable()
+    for i, subnet in enumerate(subnets):
+        ip_index_map.add(subnet['net'], netmask_bits(subnet['mask']),
+                'design.network.subnets.' + str(i))
+    return ip_index_map
+
+def create_switch_segment_map(created_app):
+    switches = ravello_template_get(created_app,
+            'design.network.switches')
+    segment_map = {}
+    for i, switch in enumerate(switches):
+        segment_map.setdefault(switch['networkSegments'][0]['id'],
+                'design.network.switches.' + str(i))
+    return segment_map
+
+
+def json_path_list_append(json_item, jspath, value):
+    item_list = ravello_template_get(json_item, jspath)
+    item_list.append(value)
+
+# hostname -> nic name -> requested address of each VM in app_request
+def requested_nic_addresses(app_request):
+    nic_addresses = {}
+    for vm in app_request['design']['vms']:
+        hostname = vm['hostnames'][0]
+        nic_addresses[hostname] = {}
+        for nic in vm['networkConnections']:
+            if json_path_contains(nic, 'ipConfig.autoIpConfig.reservedIp'):
+                nic_addresses[hostname][nic['name']] = \
+                      {'ip': nic['ipConfig']['autoIpConfig']['reservedIp'],
+                       'dhcpReservedIp': True}
+            elif json_path_contains(nic, 'ipConfig.staticIpConfig.ip'):
+                nic_addresses[hostname][nic['name']] = \
+                      {'ip': nic['ipConfig']['staticIpConfig']['ip'],
+                       'dhcpReservedIp': False}
+            else:
+                nic_addresses[hostname][nic['name']] = {'dhcpReservedIp': False}
+    return nic_addresses
 
+def reconcile_internal_luids(created_app, app_request):
+    '''
+    Fixes up created_app, as returned by Ravello, with the requested
+    addressing of app_request: NICs get their DHCP reservations, subnet
+    and switch port, and supplied services point at the ID Ravello gave
+    the NIC they name by device or IP.  Every lookup goes through an index
+    built up front, by hostnames, NIC name, IP or network, so the work is
+    linear in the number of NICs and services.
+    '''
+    dhcp_ip_mapping = create_dhcp_ip_map(created_app)
+    subnet_ip_mapping = create_subnet_ip_map(created_app)
+    switch_segment_mapping = create_switch_segment_map(created_app)
+    for dhcp in created_app['design']['network']['services']['dhcpServers']:
+        if 'reservedIpEntries' not in dhcp:
+            dhcp['reservedIpEntries'] = []
+    hostname_ip_mapping = requested_nic_addresses(app_request)
+    # the first requested VM with the same hostnames, and the first NIC
+    # of each host with a given IP
+    requested_vms = {}
+    for vm in app_request['design']['vms']:
+        requested_vms.setdefault(tuple(vm['hostnames']), vm)
+    nic_by_ip = {}
+    for hostname, nics in hostname_ip_mapping.items():
+        nic_by_ip[hostname] = {}
+        for nic_name, nic in nics.items():
+            if 'ip' in nic:
+                nic_by_ip[hostname].setdefault(nic['ip'], nic_name)
+    for i, vm in enumerate(created_app['design']['vms']):
+        for nic in vm['networkConnections']:
+          nic_ipconf_id = nic['ipConfig']['id']
+          nic_id = nic['id']
+          nic_name = nic['name']
+          vm_hostname = vm['hostnames'][0]
+          hostname_ip_mapping[vm_hostname][nic_name]['ipconf_id'] = nic_ipconf_id
+          if 'ip' in hostname_ip_mapping[vm_hostname][nic_name]:
+              nic_ip = hostname_ip_mapping[vm_hostname][nic_name]['ip']
+              if hostname_ip_mapping[vm_hostname][nic_name]['dhcpReservedIp']:
+                  item = {
+                         'ipConfigurationId': nic_ipconf_id,
+                          'ip': nic_ip
+                         }
+                  json_path_list_append(created_app,
+                          path_from_ip(created_app, 
+                              dhcp_ip_mapping,
+                              nic_ip) + '.reservedIpEntries',
+                          item)
+              subnet_ipconfig_path = path_from_ip(created_app, 
+                      subnet_ip_mapping,
+                      nic_ip)
+              switch_path = switch_segment_mapping.get(
+                      ravello_template_get(created_app,
+                          subnet_ipconfig_path + '.networkSegmentId'))
+              if switch_path is None:
+                  raise Exception('Invalid network segment')
+          else:
+              switch_path = 'design.network.switches.0'
+              subnet_ipconfig_path = 'design.network.subnets.0'
+          json_path_list_append(created_app,
+                  subnet_ipconfig_path + '.ipConfigurationIds',
+                  nic_ipconf_id)
+          create_port_on_switch(created_app, 
+                  switch_path,
+                  nic_id,
+                  'VM')
+        if 'suppliedServices' in vm:
+            old_vm = requested_vms.get(tuple(vm['hostnames']), {})
+            for j, svc in enumerate(vm ['suppliedServices']):
+                if json_path_contains(old_vm, 'suppliedServices.' + str(j)):
+                    service_req = old_vm['suppliedServices'][j]
+                    
+                    if 'device' in service_req:
+                        nic_name = service_req['device']
+                    elif 'ip' in service_req: 
+                         if service_req['ip'] not in nic_by_ip[vm_hostname]:
+                             module_fail("ip not found: " + service_req['ip'] + \
+                                 "for " + vm_hostname + " " + nic_name + \
+                                 "                      " + \
+                                 json.dumps(hostname_ip_mapping))
+                         nic_name = nic_by_ip[vm_hostname][service_req['ip']]
+                if (nic_name not in hostname_ip_mapping[vm_hostname]):
+                    module_fail(nic_name + vm_hostname + "\n" + json.dumps(hostname_ip_mapping))
+                svc['useLuidForIpConfig'] = True
+                svc['ipConfigLuid'] = \
+                    hostname_ip_mapping[vm_hostname][nic_name]['ipconf_id']
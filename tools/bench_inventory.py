@@ -0,0 +1,282 @@
+#! /usr/bin/env python
+# Benchmarks for the dynamic inventory, no Ravello account needed.
+#
+# builder: builds the inventory of a synthetic deployment with the
+#   single-pass create_inv_by_attributes from inventory/ravello.py and with
+#   the previous three-pass builder, which parsed every #%ansible block
+#   three times.
+# suite: runs RavelloInventory end to end against FakeRavelloClient
+#   (tools/fake_ravello.py) on accounts of 10, 200 and 2,000 apps, and
+#   reports wall time, peak memory and API calls for the cold, cached,
+#   incremental and --host paths.
+#
+# usage: bench_inventory.py builder [--vms 1000] [--repeat 5]
+#        bench_inventory.py suite [--apps 10,200,2000] [--vms-per-app 5]
+#                                 [--latency 0]
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+import argparse
+
+try:
+    import tracemalloc
+    HAS_TRACEMALLOC = True
+except ImportError:
+    HAS_TRACEMALLOC = False
+
+THIS_DIR = os.path.dirname(os.path.realpath(__file__))
+INVENTORY = os.path.join(THIS_DIR, '..', 'inventory', 'ravello.py')
+sys.path.insert(0, THIS_DIR)
+
+from fake_ravello import FakeRavelloAccount, FakeRavelloClient, make_apps
+
+def load_inventory():
+    try:
+        import importlib.util
+        spec = importlib.util.spec_from_file_location('ravello_inventory', INVENTORY)
+        inventory = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(inventory)
+    except ImportError:
+        import imp
+        inventory = imp.load_source('ravello_inventory', INVENTORY)
+    return inventory
+
+def make_vm(i, proxy='bastion'):
+    name = 'bastion' if i == 0 else 'node%d' % i
+    desc = '#%ansible\n'
+    desc += 'name: ' + name + '\n'
+    desc += 'groups:\n  - nodes\n  - rack%d\n' % (i % 10)
+    if i != 0:
+        desc += 'proxy: ' + proxy + '\n'
+    desc += 'vars:\n'
+    desc += '  ansible_user: cloud-user\n'
+    desc += '  ansible_ssh_private_key_file: /tmp/lab.id_rsa\n'
+    desc += '#%end\n'
+    return {
+        'name': name,
+        'description': desc,
+        'hostnames': [name + '.example.com'],
+        'externalFqdn': '%s-lab-abcdefgh.srv.ravcloud.com' % name,
+    }
+
+def make_app(num_vms, app_id=1):
+    return {
+        'id': app_id,
+        'name': 'lab%d' % app_id,
+        'published': True,
+        'deployment': {'vms': [make_vm(i) for i in range(num_vms)]},
+    }
+
+def legacy_create_inv_by_attributes(inventory, app, groups):
+    # The three pass builder, kept here as the baseline
+    get_ansible_attributes = inventory.get_ansible_attributes
+    vms = app['deployment']['vms']
+    for vm in vms:
+        hostname = vm['hostnames'][0]
+        attrs = get_ansible_attributes(vm)
+        vm_name = attrs['name']
+        if 'groups' not in attrs:
+            attrs['groups'] = []
+        if vm_name not in attrs['groups']:
+            attrs['groups'].append(vm_name)
+        for g in attrs['groups']:
+            if g not in groups:
+                groups[g] = {}
+            if 'hosts' not in groups[g]:
+                groups[g]['hosts'] = []
+            groups[g]['hosts'].append(hostname)
+        if 'externalFqdn' in vm:
+            groups['_meta']['hostvars'][hostname] = \
+                {'externalFqdn': vm['externalFqdn']}
+        groups['_meta']['hostvars'][hostname]['hostIsProxy'] = False
+        groups['_meta']['hostvars'][hostname]['hostnameIsProxy'] = False
+    for vm in vms:
+        attrs = get_ansible_attributes(vm)
+        hostname = vm['hostnames'][0]
+        hvars = attrs.get('vars', {})
+        if 'proxy' in attrs:
+            proxy_name = groups[attrs['proxy']]['hosts'][0]
+        else:
+            proxy_name = hostname
+        proxy = groups['_meta']['hostvars'][proxy_name]['externalFqdn']
+        groups['_meta']['hostvars'][hostname]['proxyFqdn'] = proxy
+        groups['_meta']['hostvars'][proxy_name]['hostIsProxy'] = True
+        hvars['ansible_ssh_common_args'] = '-o StrictHostKeyChecking=no -o ProxyCommand="ssh -i {{ hostvars["' + hostname + '"]["ansible_ssh_private_key_file"] }} -W %h:%p -q {{ hostvars["' + proxy + '"]["ansible_user"] }}@'  + proxy + '"'
+        for k, v in hvars.items():
+            groups['_meta']['hostvars'][hostname][k] = v
+    for vm in vms:
+        hostname = vm['hostnames'][0]
+        attrs = get_ansible_attributes(vm)
+        vm_name = attrs['name']
+        if groups['_meta']['hostvars'][hostname]['hostIsProxy']:
+            fqdn = groups['_meta']['hostvars'][hostname]['externalFqdn']
+            groups['_meta']['hostvars'][fqdn] = \
+                groups['_meta']['hostvars'][hostname].copy()
+            groups['_meta']['hostvars'][fqdn]['hostnameIsProxy'] = True
+            del groups['_meta']['hostvars'][fqdn]['ansible_ssh_common_args']
+            groups[vm_name + "_public"] = {"hosts": [fqdn]}
+
+def best_of(repeat, fn):
+    best = None
+    for _ in range(repeat):
+        start = time.time()
+        result = fn()
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best, result
+
+def bench_builder(args):
+    inventory = load_inventory()
+    app = make_app(args.vms)
+
+    def run_legacy():
+        groups = {'_meta': {'hostvars': {}}}
+        legacy_create_inv_by_attributes(inventory, app, groups)
+        return groups
+
+    def run_single_pass():
+        groups = {'_meta': {'hostvars': {}}}
+        inventory.create_inv_by_attributes(app, groups)
+        return groups
+
+    legacy_time, legacy_groups = best_of(args.repeat, run_legacy)
+    new_time, new_groups = best_of(args.repeat, run_single_pass)
+    if legacy_groups != new_groups:
+        sys.stderr.write('Error: builders produced different inventories\n')
+        sys.exit(1)
+
+    print('VMs:          %d' % args.vms)
+    print('three-pass:   %.3f s' % legacy_time)
+    print('single-pass:  %.3f s' % new_time)
+    print('speedup:      %.1fx' % (legacy_time / new_time))
+
+class CountingSink(object):
+    # stands in for stdout, so printing is measured but not shown
+    def __init__(self):
+        self.size = 0
+    def write(self, data):
+        self.size += len(data)
+    def flush(self):
+        pass
+
+def bump_first_app(account):
+    app = account.apps[1]
+    app['version'] += 1
+    app['deployment']['vms'][0]['externalFqdn'] = 'moved-' + app['name'] + '.srv.ravcloud.com'
+
+# name, cache_max_age, runs before measuring, measured run, change before measuring
+# Ansible runs the script with a bare --list or --host, so the account
+# wide selection comes from 'apps = *' in ravello.ini
+SCENARIOS = [
+    ('cold, cache off', 0, [], ['--list'], None),
+    ('cold, cache on', 300, [], ['--list'], None),
+    ('warm cache', 300, [['--list']], ['--list'], None),
+    ('refresh, 1 app changed', 300, [['--list']], ['--list', '--refresh-cache'], bump_first_app),
+    ('--host, warm cache', 300, [['--list']], ['--host', 'lab0001_bastion.example.com'], None),
+    ('one named app', 0, [], ['--list', 'lab0001'], None),
+]
+
+def run_inventory(inventory, argv):
+    sink = CountingSink()
+    stdout = sys.stdout
+    sys.stdout = sink
+    try:
+        inventory.RavelloInventory(argv)
+    finally:
+        sys.stdout = stdout
+    return sink.size
+
+def run_scenario(inventory, apps, scenario, latency, workers, trace):
+    name, cache_max_age, setup_runs, argv, change = scenario
+    account = FakeRavelloAccount(make_apps(*apps), latency)
+    FakeRavelloClient.account = account
+    work_dir = tempfile.mkdtemp(prefix='bench-ravello-')
+    ini_path = os.path.join(work_dir, 'ravello.ini')
+    with open(ini_path, 'w') as ini:
+        ini.write('[ravello]\n')
+        ini.write('username = bench\n')
+        ini.write('password = bench\n')
+        ini.write('cache_path = %s\n' % os.path.join(work_dir, 'inventory'))
+        ini.write('cache_max_age = %d\n' % cache_max_age)
+        ini.write('fetch_workers = %d\n' % workers)
+        ini.write('apps = *\n')
+    environ = dict(os.environ)
+    os.environ['RAVELLO_INI_PATH'] = ini_path
+    os.environ['RAVELLO_CACHE_DIR'] = os.path.join(work_dir, 'ravello')
+    try:
+        for setup_argv in setup_runs:
+            run_inventory(inventory, setup_argv)
+        if change:
+            change(account)
+        account.reset()
+        if trace:
+            tracemalloc.start()
+        start = time.time()
+        size = run_inventory(inventory, argv)
+        elapsed = time.time() - start
+        peak = None
+        if trace:
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+        return elapsed, peak, size, dict(account.calls)
+    finally:
+        os.environ.clear()
+        os.environ.update(environ)
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+def bench_suite(args):
+    inventory = load_inventory()
+    inventory.RavelloClient = FakeRavelloClient
+    inventory.HAS_RAVELLO_SDK = True
+
+    print('%-24s %6s %7s %9s %9s %10s  %s' % ('scenario', 'apps', 'VMs',
+          'wall (s)', 'peak (MB)', 'out (KB)', 'API calls'))
+    for num_apps in [int(n) for n in args.apps.split(',')]:
+        apps = (num_apps, args.vms_per_app)
+        for scenario in SCENARIOS:
+            elapsed, _, size, calls = run_scenario(inventory, apps, scenario,
+                args.latency, args.workers, False)
+            peak = None
+            if HAS_TRACEMALLOC:
+                # traced separately, tracemalloc slows everything down
+                _, peak, _, _ = run_scenario(inventory, apps, scenario,
+                    args.latency, args.workers, True)
+            print('%-24s %6d %7d %9.3f %9s %10.1f  %d %s' % (scenario[0],
+                num_apps, num_apps * args.vms_per_app, elapsed,
+                '%.1f' % (peak / 1048576.0) if peak is not None else '-',
+                size / 1024.0, sum(calls.values()),
+                ', '.join('%s=%d' % c for c in sorted(calls.items()))))
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the Ravello dynamic inventory')
+    subparsers = parser.add_subparsers(dest='command')
+    builder = subparsers.add_parser('builder',
+        help='Compare the inventory builder against the three-pass builder')
+    builder.add_argument('--vms', type=int, default=1000,
+                         help='Number of VMs in the synthetic deployment (default: 1000)')
+    builder.add_argument('--repeat', type=int, default=5,
+                         help='Runs per builder, the best time is reported (default: 5)')
+    suite = subparsers.add_parser('suite',
+        help='Run the inventory end to end against a fake Ravello account')
+    suite.add_argument('--apps', default='10,200,2000',
+                       help='Comma separated account sizes, in apps (default: 10,200,2000)')
+    suite.add_argument('--vms-per-app', type=int, default=5,
+                       help='VMs in each app (default: 5)')
+    suite.add_argument('--latency', type=float, default=0.0,
+                       help='Seconds added to every fake API call (default: 0)')
+    suite.add_argument('--workers', type=int, default=8,
+                       help='fetch_workers for the inventory (default: 8)')
+    args = parser.parse_args()
+
+    if args.command == 'suite':
+        bench_suite(args)
+    else:
+        if args.command is None:
+            args.vms, args.repeat = 1000, 5
+        bench_builder(args)
+
+main()
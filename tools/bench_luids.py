@@ -0,0 +1,189 @@
+#! /usr/bin/env python
+# Benchmark of the LUID reconciliation done by ravello_module's design
+# state, no Ravello account needed.
+#
+# Builds a synthetic app request of --vms VMs spread over --subnets
+# networks, each VM with a DHCP reserved and a static NIC and a service on
+# each, and the matching application as Ravello returns it.  Then times
+# reconcile_internal_luids from module_utils/ravello_utils.py against the
+# previous implementation, which filtered the requested VMs and scanned
+# every network for each NIC.  The previous implementation needs netaddr.
+#
+# usage: bench_luids.py [--vms 1000] [--subnets 8] [--repeat 3]
+
+import os
+import sys
+import copy
+import json
+import time
+import argparse
+
+THIS_DIR = os.path.dirname(os.path.realpath(__file__))
+sys.path.insert(0, os.path.join(THIS_DIR, '..', 'module_utils'))
+
+from ravello_utils import PlanClient, reconcile_internal_luids, \
+    ravello_template_get, json_path_contains, create_port_on_switch
+
+try:
+    from netaddr import IPAddress, IPNetwork
+    HAS_NETADDR = True
+except ImportError:
+    HAS_NETADDR = False
+
+def make_request(num_vms, num_subnets):
+    vms = []
+    for i in range(num_vms):
+        net = i % num_subnets
+        host = 3 + i // num_subnets
+        reserved_ip = '10.%d.%d.%d' % (net, host // 250, host % 250)
+        static_ip = '10.%d.%d.%d' % ((net + 1) % num_subnets, 200 + host // 250, host % 250)
+        vms.append({
+            'name': 'vm%d' % i,
+            'hostnames': ['vm%d.example.com' % i],
+            'networkConnections': [
+                {'name': 'eth0',
+                 'ipConfig': {'autoIpConfig': {'reservedIp': reserved_ip}}},
+                {'name': 'eth1',
+                 'ipConfig': {'staticIpConfig': {'ip': static_ip, 'mask': '255.255.0.0'}}},
+            ],
+            'suppliedServices': [
+                {'name': 'ssh', 'portRange': '22', 'device': 'eth0'},
+                {'name': 'web', 'portRange': '80', 'ip': static_ip},
+            ],
+        })
+    return {'name': 'bench', 'design': {'vms': vms}}
+
+def make_created_app(app_request, num_subnets):
+    # the application after the design state built its network
+    plan = PlanClient()
+    app = plan.create_application(app_request)
+    network = app['design'].setdefault('network', {})
+    network['switches'] = [{'networkSegments': [{'vlanId': 1}], 'ports': []}
+                           for _ in range(num_subnets)]
+    plan.update_application(app)
+    app = plan.get_application(app['id'])
+    network = app['design']['network']
+    network['subnets'] = []
+    network['services'] = {'dhcpServers': []}
+    for i in range(num_subnets):
+        network['subnets'].append({
+            'ipVersion': 'IPV4', 'mask': '255.255.0.0', 'net': '10.%d.0.0' % i,
+            'networkSegmentId': network['switches'][i]['networkSegments'][0]['id']})
+        network['services']['dhcpServers'].append({
+            'mask': '255.255.0.0', 'poolStart': '10.%d.0.0' % i,
+            'poolEnd': '10.%d.255.255' % i})
+    return plan.update_application(app)
+
+def legacy_path_from_ip(path_map, ip_addr):
+    for net_block, path in path_map.items():
+        if IPAddress(ip_addr) in IPNetwork(net_block):
+            return path
+    raise Exception('no subnet for ip: ' + ip_addr)
+
+def legacy_ip_map(items, net_key, prefix):
+    ip_index_map = {}
+    for i, item in enumerate(items):
+        cidr_num = IPAddress(item['mask']).netmask_bits()
+        ip_index_map[item[net_key] + '/' + str(cidr_num)] = prefix + str(i)
+    return ip_index_map
+
+def legacy_switch_path_from_ip(created_app, subnet_ip_map, ip_addr):
+    network_segment_id = ravello_template_get(created_app,
+        legacy_path_from_ip(subnet_ip_map, ip_addr) + '.networkSegmentId')
+    for i, switch in enumerate(created_app['design']['network']['switches']):
+        if switch['networkSegments'][0]['id'] == network_segment_id:
+            return 'design.network.switches.' + str(i)
+    raise Exception('Invalid network segment')
+
+def legacy_reconcile(created_app, app_request):
+    # the reconciliation as update_app_with_internal_luids used to do it
+    network = created_app['design']['network']
+    dhcp_ip_mapping = legacy_ip_map(network['services']['dhcpServers'],
+        'poolStart', 'design.network.services.dhcpServers.')
+    subnet_ip_mapping = legacy_ip_map(network['subnets'], 'net',
+        'design.network.subnets.')
+    for dhcp in network['services']['dhcpServers']:
+        dhcp.setdefault('reservedIpEntries', [])
+    hostname_ip_mapping = {}
+    for vm in app_request['design']['vms']:
+        hostname = vm['hostnames'][0]
+        hostname_ip_mapping[hostname] = {}
+        for nic in vm['networkConnections']:
+            if json_path_contains(nic, 'ipConfig.autoIpConfig.reservedIp'):
+                hostname_ip_mapping[hostname][nic['name']] = \
+                    {'ip': nic['ipConfig']['autoIpConfig']['reservedIp'], 'dhcpReservedIp': True}
+            elif json_path_contains(nic, 'ipConfig.staticIpConfig.ip'):
+                hostname_ip_mapping[hostname][nic['name']] = \
+                    {'ip': nic['ipConfig']['staticIpConfig']['ip'], 'dhcpReservedIp': False}
+            else:
+                hostname_ip_mapping[hostname][nic['name']] = {'dhcpReservedIp': False}
+    for vm in created_app['design']['vms']:
+        vm_hostname = vm['hostnames'][0]
+        for nic in vm['networkConnections']:
+            mapping = hostname_ip_mapping[vm_hostname][nic['name']]
+            mapping['ipconf_id'] = nic['ipConfig']['id']
+            nic_ip = mapping['ip']
+            if mapping['dhcpReservedIp']:
+                ravello_template_get(created_app,
+                    legacy_path_from_ip(dhcp_ip_mapping, nic_ip) + '.reservedIpEntries'
+                ).append({'ipConfigurationId': nic['ipConfig']['id'], 'ip': nic_ip})
+            switch_path = legacy_switch_path_from_ip(created_app, subnet_ip_mapping, nic_ip)
+            subnet_path = legacy_path_from_ip(subnet_ip_mapping, nic_ip)
+            ravello_template_get(created_app, subnet_path + '.ipConfigurationIds').append(
+                nic['ipConfig']['id'])
+            create_port_on_switch(created_app, switch_path, nic['id'], 'VM')
+        for j, svc in enumerate(vm.get('suppliedServices', [])):
+            old_vm = list(filter(lambda v: v['hostnames'] == vm['hostnames'],
+                                 app_request['design']['vms']))[0]
+            service_req = old_vm['suppliedServices'][j]
+            if 'device' in service_req:
+                nic_name = service_req['device']
+            else:
+                for entry in hostname_ip_mapping[vm_hostname]:
+                    if service_req['ip'] == hostname_ip_mapping[vm_hostname][entry]['ip']:
+                        nic_name = entry
+                        break
+            svc['useLuidForIpConfig'] = True
+            svc['ipConfigLuid'] = hostname_ip_mapping[vm_hostname][nic_name]['ipconf_id']
+
+def best_of(repeat, fn, app_request, created_app):
+    best = None
+    for _ in range(repeat):
+        app = copy.deepcopy(created_app)
+        start = time.time()
+        fn(app, app_request)
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best, app
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the design state LUID reconciliation')
+    parser.add_argument('--vms', type=int, default=1000,
+                        help='Number of VMs in the synthetic template (default: 1000)')
+    parser.add_argument('--subnets', type=int, default=8,
+                        help='Number of networks (default: 8)')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='Runs per implementation, the best time is reported (default: 3)')
+    args = parser.parse_args()
+
+    app_request = make_request(args.vms, args.subnets)
+    created_app = make_created_app(app_request, args.subnets)
+
+    new_time, new_app = best_of(args.repeat, reconcile_internal_luids,
+                                app_request, created_app)
+    print('VMs:       %d (%d NICs, %d services)' % (args.vms, 2 * args.vms, 2 * args.vms))
+    print('subnets:   %d' % args.subnets)
+    print('indexed:   %.3f s' % new_time)
+    if not HAS_NETADDR:
+        print('previous:  skipped, netaddr is not installed')
+        return
+    legacy_time, legacy_app = best_of(args.repeat, legacy_reconcile,
+                                      app_request, created_app)
+    if json.dumps(legacy_app, sort_keys=True) != json.dumps(new_app, sort_keys=True):
+        sys.stderr.write('Error: implementations produced different applications\n')
+        sys.exit(1)
+    print('previous:  %.3f s' % legacy_time)
+    print('speedup:   %.1fx' % (legacy_time / new_time))
+
+main()
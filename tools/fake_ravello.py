@@ -0,0 +1,142 @@
+#! /usr/bin/env python
+# A local stand-in for ravello_sdk.RavelloClient, used by the benchmarks.
+#
+# FakeRavelloClient serves applications from a FakeRavelloAccount held in
+# memory, counts every API call and can add a fixed latency per call to
+# model the round trip to Ravello.  Only the calls made by the inventory
+# script and ravello_module are implemented.
+
+import copy
+import time
+import threading
+import collections
+
+class FakeRavelloError(Exception):
+    def __init__(self, msg, status_code):
+        Exception.__init__(self, msg)
+        self.response = collections.namedtuple('Response', 'status_code')(status_code)
+
+class FakeRavelloAccount(object):
+
+    def __init__(self, apps, latency=0.0):
+        self.apps = dict((app['id'], app) for app in apps)
+        self.latency = latency
+        self.calls = collections.Counter()
+        self.lock = threading.Lock()
+
+    def record(self, call):
+        with self.lock:
+            self.calls[call] += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def reset(self):
+        with self.lock:
+            self.calls.clear()
+
+    def summary(self, app):
+        return dict((k, v) for k, v in app.items()
+                    if k not in ('deployment', 'design'))
+
+class FakeConnection(object):
+    def __init__(self):
+        self.cookies = {'JSESSIONID': 'fake-session'}
+
+class FakeRavelloClient(object):
+    # set by the benchmark before the inventory creates clients
+    account = None
+    url = 'https://fake.ravello.local/api/v1'
+
+    def __init__(self, username=None, password=None, url=None):
+        self._connection = None
+        self._autologin = True
+
+    def login(self, username=None, password=None):
+        self.account.record('login')
+        self._connection = FakeConnection()
+
+    def logout(self):
+        self.account.record('logout')
+        self._connection = None
+
+    def get_applications(self, filter=None):
+        self.account.record('get_applications')
+        apps = [self.account.summary(app) for app in self.account.apps.values()]
+        if filter:
+            apps = [app for app in apps
+                    if all(app.get(k) == v for k, v in filter.items())]
+        return apps
+
+    def get_application(self, app, aspect=None):
+        self.account.record('get_application')
+        app_id = app['id'] if isinstance(app, dict) else app
+        if app_id not in self.account.apps:
+            raise FakeRavelloError('application %s not found' % app_id, 404)
+        app = self.account.apps[app_id]
+        if aspect is None:
+            return copy.deepcopy(app)
+        doc = self.account.summary(app)
+        doc[aspect] = copy.deepcopy(app.get(aspect, {}))
+        return doc
+
+    def set_vm_states(self, app, state):
+        app_id = app['id'] if isinstance(app, dict) else app
+        if app_id not in self.account.apps:
+            raise FakeRavelloError('application %s not found' % app_id, 404)
+        for vm in self.account.apps[app_id].get('deployment', {}).get('vms', []):
+            vm['state'] = state
+
+    def start_application(self, app):
+        self.account.record('start_application')
+        self.set_vm_states(app, 'STARTED')
+
+    def stop_application(self, app):
+        self.account.record('stop_application')
+        self.set_vm_states(app, 'STOPPED')
+
+    def delete_application(self, app):
+        self.account.record('delete_application')
+        app_id = app['id'] if isinstance(app, dict) else app
+        if self.account.apps.pop(app_id, None) is None:
+            raise FakeRavelloError('application %s not found' % app_id, 404)
+
+    def request(self, method, path, entity=None):
+        self.account.record('request %s %s' % (method, path))
+        if path == '/applications/filter':
+            name = entity['criteria'][0]['operand']
+            return [self.account.summary(app)
+                    for app in self.account.apps.values() if app['name'] == name]
+        raise FakeRavelloError('%s %s not implemented' % (method, path), 404)
+
+def make_vm(app_name, i):
+    name = 'bastion' if i == 0 else 'node%d' % i
+    desc = '#%ansible\n'
+    desc += 'name: ' + name + '\n'
+    desc += 'groups:\n  - nodes\n'
+    if i != 0:
+        desc += 'proxy: bastion\n'
+    desc += 'vars:\n'
+    desc += '  ansible_user: cloud-user\n'
+    desc += '  ansible_ssh_private_key_file: /tmp/lab.id_rsa\n'
+    desc += '#%end\n'
+    desc += 'tag:' + ('bastion' if i == 0 else 'node') + '\n'
+    return {
+        'name': name,
+        'description': desc,
+        'hostnames': [name + '.example.com'],
+        'externalFqdn': '%s-%s.srv.ravcloud.com' % (name, app_name),
+        'state': 'STARTED',
+    }
+
+def make_apps(num_apps, vms_per_app):
+    apps = []
+    for app_id in range(1, num_apps + 1):
+        name = 'lab%04d' % app_id
+        apps.append({
+            'id': app_id,
+            'name': name,
+            'published': True,
+            'version': 1,
+            'deployment': {'vms': [make_vm(name, i) for i in range(vms_per_app)]},
+        })
+    return apps